@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Box 2.0 endpoints used by BoxApi(folders, files,
+content, upload, events and oauth token), with configurable latency and
+bandwidth.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import urlparse
+
+ROOT_ID = "0"
+BLOCK_SIZE = 65536
+# fields of listing entries unless others are asked for, as Box has
+MINI_FIELDS = ('name', 'sha1', 'etag', 'sequence_id')
+
+# (method, path pattern, handler name); ids are digits
+ROUTES = (
+        ('POST', r"/oauth2/token", 'token'),
+        ('GET', r"/2\.0/users/me", 'me'),
+        ('GET', r"/2\.0/folders/(\d+)/items", 'items'),
+        ('GET', r"/2\.0/(file|folder)s/(\d+)", 'info'),
+        ('PUT', r"/2\.0/(file|folder)s/(\d+)", 'update'),
+        ('DELETE', r"/2\.0/(file|folder)s/(\d+)", 'delete'),
+        ('POST', r"/2\.0/folders", 'mkdir'),
+        ('GET', r"/2\.0/files/(\d+)/content", 'download'),
+        ('POST', r"/2\.0/upload/files(?:/(\d+))?/content", 'upload'),
+        ('GET', r"/2\.0/events", 'events'),
+        )
+ROUTES = [(method, re.compile(pattern + "$"), name)
+        for method, pattern, name in ROUTES]
+
+
+class BoxError(Exception):
+    """An error response"""
+
+    def __init__(self, status, code):
+        super(BoxError, self).__init__(code)
+        self.status = status
+        self.code = code
+
+
+def select_fields(obj, fields):
+    """Return only the given fields(and the type and id) of an object"""
+    return dict((key, value) for key, value in obj.iteritems()
+            if key in ('type', 'id') or key in fields)
+
+
+def file_content(path, size):
+    """Return the deterministic content of the file at the given path"""
+    block = hashlib.sha1(path.encode('utf-8')).digest() * (BLOCK_SIZE // 20)
+    return (block * (size // len(block) + 1))[:size]
+
+
+def tree_paths(depth, fanout, files, prefix=u""):
+    """Yield (relative path, is_dir) of a tree with `fanout` folders and
+    `files` files in each folder, `depth` levels deep, parents first.
+    """
+    for i in xrange(files):
+        yield os.path.join(prefix, u"file{}.dat".format(i)), False
+    if depth <= 1:
+        return
+    for i in xrange(fanout):
+        folder = os.path.join(prefix, u"dir{}".format(i))
+        yield folder, True
+        for item in tree_paths(depth - 1, fanout, files, folder):
+            yield item
+
+
+def write_tree(localdir, depth, fanout, files, file_size):
+    """Create the tree of `tree_paths` under a local directory"""
+    if not os.path.isdir(localdir):
+        os.makedirs(localdir)
+    for path, is_dir in tree_paths(depth, fanout, files):
+        fullpath = os.path.join(localdir, path)
+        if is_dir:
+            os.mkdir(fullpath)
+        else:
+            with open(fullpath, 'wb') as f:
+                f.write(file_content(path, file_size))
+
+
+class FakeBox(object):
+    """In-memory Box account"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(int(ROOT_ID) + 1)
+        self._nodes = {}
+        self._children = {}
+        self._events = []
+        self._add("folder", u"All Files", None)
+
+    def _add(self, type_, name, parent_id, content=None):
+        id_ = ROOT_ID if parent_id is None else str(next(self._ids))
+        node = {'type': type_, 'id': id_, 'name': name, 'etag': "0",
+                'sequence_id': "0", 'parent_id': parent_id}
+        if type_ == "file":
+            node['content'] = content
+            node['sha1'] = hashlib.sha1(content).hexdigest()
+            node['size'] = len(content)
+        else:
+            node['size'] = 0
+            self._children[id_] = []
+        self._nodes[id_] = node
+        if parent_id is not None:
+            self._children[parent_id].append(id_)
+            self._touch(parent_id)
+            self._event("ITEM_UPLOAD" if type_ == "file" else "ITEM_CREATE",
+                    self.view(node))
+        return node
+
+    def _event(self, event_type, source):
+        self._events.append({'type': "event",
+            'event_id': str(len(self._events) + 1),
+            'event_type': event_type, 'source': source})
+
+    def _touch(self, id_):
+        node = self._nodes[id_]
+        node['etag'] = str(int(node['etag']) + 1)
+        node['sequence_id'] = str(int(node['sequence_id']) + 1)
+
+    def _get(self, type_, id_):
+        node = self._nodes.get(id_)
+        if node is None or node['type'] != type_:
+            raise BoxError(404, "not_found")
+        return node
+
+    def _find(self, parent_id, name):
+        for child_id in self._children[parent_id]:
+            if self._nodes[child_id]['name'] == name:
+                return self._nodes[child_id]
+
+    def view(self, node):
+        """Return the JSON object of a node"""
+        obj = dict((key, value) for key, value in node.iteritems()
+                if key not in ('content', 'parent_id'))
+        parent_id = node['parent_id']
+        obj['parent'] = parent_id and {'type': "folder", 'id': parent_id,
+                'name': self._nodes[parent_id]['name']}
+        return obj
+
+    def populate(self, name, depth, fanout, files, file_size,
+            parent_id=ROOT_ID):
+        """Create the tree of `tree_paths` in a new folder, return its id"""
+        with self._lock:
+            root = self._add("folder", name, parent_id)
+            ids = {u"": root['id']}
+            for path, is_dir in tree_paths(depth, fanout, files):
+                parent = ids[os.path.dirname(path)]
+                basename = os.path.basename(path)
+                if is_dir:
+                    ids[path] = self._add("folder", basename, parent)['id']
+                else:
+                    self._add("file", basename, parent,
+                            file_content(path, file_size))
+            return root['id']
+
+    def info(self, type_, id_):
+        with self._lock:
+            node = self._get(type_, id_)
+            ancestors = []
+            parent_id = node['parent_id']
+            while parent_id is not None:
+                parent = self._nodes[parent_id]
+                ancestors.insert(0, {'type': "folder", 'id': parent['id'],
+                    'name': parent['name']})
+                parent_id = parent['parent_id']
+            return dict(self.view(node), path_collection={
+                'total_count': len(ancestors), 'entries': ancestors})
+
+    def items(self, folder_id, offset, limit, usemarker=False,
+            fields=MINI_FIELDS):
+        """Return a page of a folder's items; with `usemarker` the offset
+        is taken from, and the next one given as, an opaque marker.
+        """
+        with self._lock:
+            children = self._children[self._get("folder", folder_id)['id']]
+            entries = [select_fields(self.view(self._nodes[id_]), fields)
+                    for id_ in children[offset:offset + limit]]
+            if usemarker:
+                end = offset + limit
+                return {'limit': limit, 'entries': entries,
+                        'next_marker': "m{}".format(end)
+                        if end < len(children) else ""}
+            return {'total_count': len(children), 'offset': offset,
+                    'limit': limit, 'entries': entries}
+
+    def events(self, position, limit):
+        """Return a page of the changes stream from the given position
+        ("now" for the current end of it).
+        """
+        with self._lock:
+            if position == "now":
+                position = len(self._events)
+            entries = self._events[position:position + limit]
+            return {'chunk_size': len(entries), 'entries': entries,
+                    'next_stream_position': position + len(entries)}
+
+    def mkdir(self, parent_id, name):
+        with self._lock:
+            self._get("folder", parent_id)
+            if self._find(parent_id, name):
+                raise BoxError(409, "item_name_in_use")
+            return self.view(self._add("folder", name, parent_id))
+
+    def update(self, type_, id_, name=None, parent_id=None):
+        with self._lock:
+            node = self._get(type_, id_)
+            new_parent = parent_id or node['parent_id']
+            self._get("folder", new_parent)
+            ancestor = new_parent
+            while ancestor is not None:
+                if ancestor == id_:
+                    raise BoxError(400, "bad_request")
+                ancestor = self._nodes[ancestor]['parent_id']
+            new_name = name or node['name']
+            existing = self._find(new_parent, new_name)
+            if existing is not None and existing is not node:
+                raise BoxError(409, "item_name_in_use")
+            if new_parent != node['parent_id']:
+                self._children[node['parent_id']].remove(id_)
+                self._touch(node['parent_id'])
+                self._children[new_parent].append(id_)
+            moved = new_parent != node['parent_id']
+            node['name'] = new_name
+            node['parent_id'] = new_parent
+            self._touch(new_parent)
+            self._touch(id_)
+            self._event("ITEM_MOVE" if moved else "ITEM_RENAME",
+                    self.view(node))
+            return self.view(node)
+
+    def delete(self, type_, id_, recursive=False):
+        with self._lock:
+            node = self._get(type_, id_)
+            if type_ == "folder":
+                if id_ == ROOT_ID:
+                    raise BoxError(400, "bad_request")
+                if self._children[id_] and not recursive:
+                    raise BoxError(400, "folder_not_empty")
+                pending = [id_]
+                while pending:
+                    folder_id = pending.pop()
+                    for child_id in self._children.pop(folder_id):
+                        if self._nodes[child_id]['type'] == "folder":
+                            pending.append(child_id)
+                        del self._nodes[child_id]
+            self._event("ITEM_TRASH", dict(self.view(node),
+                item_status="trashed"))
+            del self._nodes[id_]
+            self._children[node['parent_id']].remove(id_)
+            self._touch(node['parent_id'])
+
+    def content(self, id_):
+        with self._lock:
+            return self._get("file", id_)['content']
+
+    def upload(self, parent_id, name, content, file_id=None):
+        """Create a file, or a new version of the given one"""
+        with self._lock:
+            if file_id:
+                node = self._get("file", file_id)
+                node['content'] = content
+                node['sha1'] = hashlib.sha1(content).hexdigest()
+                node['size'] = len(content)
+                self._touch(file_id)
+                self._touch(node['parent_id'])
+                self._event("ITEM_UPLOAD", self.view(node))
+                return self.view(node)
+            self._get("folder", parent_id)
+            if self._find(parent_id, name):
+                raise BoxError(409, "item_name_in_use")
+            return self.view(self._add("file", name, parent_id, content))
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    # send the status line, headers and small bodies in one packet, so
+    # that the stand-in adds no delay of its own
+    wbufsize = BLOCK_SIZE
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        parsed = urlparse.urlsplit(self.path)
+        for method, pattern, name in ROUTES:
+            matched = pattern.match(parsed.path)
+            if method == self.command and matched:
+                query = dict(urlparse.parse_qsl(parsed.query))
+                return name, matched.groups(), query
+        return None, (), {}
+
+    def _handle(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        name, groups, query = self._route()
+        server.count(self.command, name or "unknown")
+        try:
+            if name is None:
+                raise BoxError(404, "not_found")
+            getattr(self, "_" + name)(*groups, **query)
+        except BoxError as e:
+            self._drain()
+            self._send_json({'type': "error", 'status': e.status,
+                'code': e.code}, e.status)
+        except Exception as e: # a bug of the stand-in or a bad request
+            self._drain()
+            self._send_json({'type': "error", 'status': 500,
+                'code': "internal_server_error", 'message': str(e)}, 500)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    def _drain(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length and not getattr(self, '_body_read', False):
+            self.rfile.read(length)
+
+    def _read_body(self):
+        self._body_read = True
+        data = self.rfile.read(int(self.headers.getheader('Content-Length')
+            or 0))
+        self.server.pace(len(data), True)
+        return data
+
+    def _read_json(self):
+        try:
+            return json.loads(self._read_body())
+        except ValueError:
+            raise BoxError(400, "bad_request")
+
+    def _send(self, status, body="", headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not body:
+            self.wfile.flush()
+        for offset in xrange(0, len(body), BLOCK_SIZE):
+            chunk = body[offset:offset + BLOCK_SIZE]
+            self.server.pace(len(chunk), False)
+            self.wfile.write(chunk)
+            self.wfile.flush()
+
+    def _send_json(self, obj, status=200):
+        self._send(status, json.dumps(obj),
+                [('Content-Type', "application/json")])
+
+    def _token(self):
+        self._read_body()
+        self._send_json({'access_token': "access-{}".format(time.time()),
+            'refresh_token': "refresh-{}".format(time.time()),
+            'expires_in': 3600, 'token_type': "bearer"})
+
+    def _me(self):
+        self._send_json({'type': "user", 'id': "1", 'name': "bench",
+            'login': "bench@example.com"})
+
+    def _items(self, folder_id, offset=0, limit=100, usemarker=None,
+            marker=None, fields=None, **_):
+        if usemarker == "true":
+            offset = marker[1:] if marker else 0
+        self._send_json(self.server.box.items(folder_id, int(offset),
+            int(limit), usemarker == "true",
+            fields.split(",") if fields else MINI_FIELDS))
+
+    def _events(self, stream_position="now", limit=100, **_):
+        self._send_json(self.server.box.events(stream_position
+            if stream_position == "now" else int(stream_position),
+            int(limit)))
+
+    def _info(self, type_, id_, fields=None):
+        info = self.server.box.info(type_, id_)
+        if fields: # like Box, only the requested fields and the basics
+            info = select_fields(info, fields.split(","))
+        self._send_json(info)
+
+    def _update(self, type_, id_):
+        data = self._read_json()
+        self._send_json(self.server.box.update(type_, id_,
+            data.get('name'), (data.get('parent') or {}).get('id')))
+
+    def _delete(self, type_, id_, recursive="false"):
+        self.server.box.delete(type_, id_, recursive == "true")
+        self._send(204)
+
+    def _mkdir(self):
+        data = self._read_json()
+        self._send_json(self.server.box.mkdir(data['parent']['id'],
+            data['name']), 201)
+
+    def _download(self, id_):
+        content = self.server.box.content(id_)
+        range_ = re.match(r"bytes=(\d+)-(\d*)$",
+                self.headers.getheader('Range') or "")
+        if not range_:
+            self._send(200, content)
+            return
+        start = int(range_.group(1))
+        end = min(int(range_.group(2) or len(content) - 1), len(content) - 1)
+        if start >= len(content):
+            self._send(416, "", [('Content-Range',
+                "bytes */{}".format(len(content)))])
+            return
+        self._send(206, content[start:end + 1], [('Content-Range',
+            "bytes {}-{}/{}".format(start, end, len(content)))])
+
+    def _upload(self, file_id=None):
+        self._body_read = True
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.server.pace(length, True)
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                environ={'REQUEST_METHOD': "POST",
+                    'CONTENT_TYPE': self.headers.getheader('Content-Type')})
+        field = form['filename']
+        content = field.file.read()
+        sha1 = self.headers.getheader('Content-MD5')
+        if sha1 and sha1 != hashlib.sha1(content).hexdigest():
+            raise BoxError(400, "sha1_mismatch")
+        node = self.server.box.upload(form.getfirst('parent_id'),
+                field.filename.decode('utf-8'), content, file_id)
+        self._send_json({'total_count': 1, 'entries': [node]}, 201)
+
+
+class FakeBoxServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server of a `FakeBox` on localhost.
+
+    Each request is delayed by `latency` seconds, and bodies are sent and
+    received at `bandwidth` bytes per second(unlimited if None).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, box=None, latency=0, bandwidth=None, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                _Handler)
+        self.box = box or FakeBox()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': {}, 'bytes_in': 0, 'bytes_out': 0}
+
+    def stats(self):
+        """Return requests per "METHOD endpoint", and bytes of bodies
+        received and sent.
+        """
+        with self._lock:
+            return dict(self._stats, requests=dict(self._stats['requests']))
+
+    def count(self, method, name):
+        key = "{} {}".format(method, name)
+        with self._lock:
+            requests = self._stats['requests']
+            requests[key] = requests.get(key, 0) + 1
+
+    def pace(self, size, incoming):
+        with self._lock:
+            self._stats['bytes_in' if incoming else 'bytes_out'] += size
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def configure(self, api):
+        """Point a `BoxApi` to this server"""
+        api.BASE_URL = self.url + "/2.0/"
+        api.TOKEN_URL = self.url + "/oauth2/token"
+        api.UPLOAD_URL = self.url + "/2.0/upload/files{}/content"
+        api.UPLOAD_SESSION_URL = \
+                self.url + "/2.0/upload/files{}/upload_sessions"
+        api.DOWNLOAD_URL = api.BASE_URL + "files/{}/content"
+        api.EVENTS_URL = api.BASE_URL + "events"
+        return api
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of BoxApi against a local fake Box server(see fakebox.py).
+
+Every run starts from a fresh remote tree, local directory and cache, and
+only the operation itself is timed. Results(with the requests and bytes
+each operation took) are written as JSON, and can be compared with those
+of an earlier version.
+
+usage: python bench/run.py [options] [benchmark ...]
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakebox import FakeBox, FakeBoxServer, file_content, \
+        tree_paths, write_tree
+
+ACCOUNT = "bench"
+TREE_NAME = u"bench"
+BOXRC = """[app]
+client_id = bench
+client_secret = bench
+
+[account-{}]
+access_token = bench
+refresh_token = bench
+token_time = {}
+"""
+LOGGING_CONF = """[loggers]
+keys=root,box
+
+[handlers]
+keys=stderrHandler
+
+[formatters]
+keys=
+
+[logger_root]
+level=WARNING
+handlers=stderrHandler
+
+[logger_box]
+level=WARNING
+handlers=stderrHandler
+qualname=box
+propagate=0
+
+[handler_stderrHandler]
+class=StreamHandler
+level=WARNING
+args=(sys.stderr,)
+"""
+
+
+class Context(object):
+    """Fresh state of a benchmark run: a fake account holding the tree,
+    a scratch directory and a client.
+    """
+
+    def __init__(self, server, options):
+        self.options = options
+        self.server = server
+        server.box = FakeBox()
+        self.tree_id = server.box.populate(TREE_NAME, options.depth,
+                options.fanout, options.files, options.file_size)
+        self.workdir = tempfile.mkdtemp(prefix="boxbench-")
+        self.localdir = os.path.join(self.workdir, TREE_NAME)
+        import pybox.cache
+        pybox.cache.CACHE_DIR = os.path.join(self.workdir, "cache")
+        self.client_options = {}
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from pybox.boxapi import BoxApi
+            from pybox.retry import AdaptiveLimiter
+            self._client = self.server.configure(BoxApi(
+                jobs=self.options.jobs, **self.client_options))
+            if self.options.max_rate:
+                self._client.limiter = AdaptiveLimiter(
+                        self.options.max_rate, self.options.jobs)
+            self._client.get_auth_token(ACCOUNT, None)
+        return self._client
+
+    def paths(self):
+        return tree_paths(self.options.depth, self.options.fanout,
+                self.options.files)
+
+    def write_tree(self):
+        o = self.options
+        write_tree(self.localdir, o.depth, o.fanout, o.files, o.file_size)
+
+    def restart(self):
+        """Close the client, the next one starts from the caches on disk"""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def close(self):
+        self.restart()
+        shutil.rmtree(self.workdir)
+
+
+def bench_list(ctx):
+    """List every folder of the tree"""
+    pending = [ctx.tree_id]
+    while pending:
+        for entry in ctx.client.iter_list(pending.pop()):
+            if entry['type'] == "folder":
+                pending.append(entry['id'])
+
+
+def bench_get_file_id(ctx):
+    """Look up every file of the tree by path"""
+    for path, is_dir in ctx.paths():
+        if not is_dir:
+            id_, _ = ctx.client.get_file_id(
+                    os.path.join(TREE_NAME, path), True)
+            assert id_, u"{} not found".format(path)
+
+
+def setup_compare_dir(ctx):
+    ctx.write_tree()
+
+
+def bench_compare_dir(ctx):
+    """Compare the tree with an identical local copy"""
+    ctx.client.compare_dir(ctx.localdir, ctx.tree_id).close()
+
+
+def setup_compare_events(ctx):
+    """Index the tree following events, then change its deepest file"""
+    ctx.write_tree()
+    ctx.client_options['use_events'] = True
+    ctx.client.compare_dir(ctx.localdir, ctx.tree_id).close()
+    path = [p for p, is_dir in ctx.paths() if not is_dir][-1]
+    id_, _ = ctx.client.get_file_id(os.path.join(TREE_NAME, path), True)
+    ctx.server.box.upload(None, None, file_content(path + u"~",
+        ctx.options.file_size), id_)
+    ctx.restart()
+
+
+def bench_compare_events(ctx):
+    """Compare the tree incrementally after a change, with --events"""
+    result = ctx.client.compare_dir(ctx.localdir, ctx.tree_id)
+    try:
+        diff_files = result.report()[4]
+    finally:
+        result.close()
+    assert len(diff_files) == 1, u"changes found: {}".format(diff_files)
+
+
+def setup_sync(ctx):
+    """Change every 10th file, and add a file to each folder"""
+    ctx.write_tree()
+    for i, (path, is_dir) in enumerate(ctx.paths()):
+        fullpath = os.path.join(ctx.localdir, path)
+        if is_dir:
+            with open(os.path.join(fullpath, "new.dat"), 'wb') as f:
+                f.write(file_content(path + u"/new",
+                    ctx.options.file_size))
+        elif i % 10 == 0:
+            with open(fullpath, 'wb') as f:
+                f.write(file_content(path + u"~", ctx.options.file_size))
+
+
+def bench_sync(ctx):
+    """Sync a local copy of the tree with some files changed and added"""
+    ctx.client.sync(ctx.localdir, ctx.tree_id)
+
+
+def setup_upload(ctx):
+    ctx.write_tree()
+    ctx.server.box.delete("folder", ctx.tree_id, True)
+
+
+def bench_upload(ctx):
+    """Upload the tree to an empty account"""
+    ctx.client.upload(ctx.localdir)
+
+
+def bench_download_dir(ctx):
+    """Download the tree to an empty directory"""
+    ctx.client.download_dir(ctx.tree_id, ctx.workdir)
+
+
+BENCHMARKS = ('list', 'get_file_id', 'compare_dir', 'compare_events',
+        'sync', 'upload', 'download_dir')
+
+
+def run_benchmark(name, server, options):
+    setup = globals().get("setup_" + name)
+    operate = globals()["bench_" + name]
+    runs = []
+    for _ in xrange(options.runs):
+        ctx = Context(server, options)
+        try:
+            if setup:
+                setup(ctx)
+            ctx.client # login is not measured
+            server.reset_stats()
+            start = time.time()
+            operate(ctx)
+            seconds = time.time() - start
+            runs.append((seconds, server.stats()))
+        finally:
+            ctx.close()
+    runs.sort(key=lambda run: run[0])
+    seconds, stats = runs[len(runs) // 2]
+    return dict(stats, description=operate.__doc__, runs=len(runs),
+            min_seconds=round(runs[0][0], 4),
+            median_seconds=round(seconds, 4),
+            max_seconds=round(runs[-1][0], 4))
+
+
+def _revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(["git", "describe", "--always",
+                "--dirty"], cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each benchmark's median from a baseline, and
+    return the names of those slower by more than `threshold`(a ratio).
+    """
+    regressions = []
+    for name, result in sorted(results['benchmarks'].iteritems()):
+        base = baseline['benchmarks'].get(name)
+        if not base or not base['median_seconds']:
+            continue
+        ratio = result['median_seconds'] / base['median_seconds']
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print >>sys.stderr, "{:<14} {:>9.4f}s -> {:>9.4f}s x{:.2f}{}".format(
+                name, base['median_seconds'],
+                result['median_seconds'], ratio, flag)
+    return regressions
+
+
+def parse_args(argv):
+    parser = OptionParser("usage: %prog [options] [benchmark ...]\n\n"
+            "benchmarks: " + ", ".join(BENCHMARKS))
+    parser.add_option("-n", "--runs", type="int", dest="runs", default=3,
+            help="runs of each benchmark, the median is reported"
+            "(default: 3)")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=4,
+            help="jobs of the client(default: 4)")
+    parser.add_option("--latency", type="float", dest="latency",
+            default=20, metavar="MS",
+            help="delay of each request in milliseconds(default: 20)")
+    parser.add_option("--bandwidth", type="int", dest="bandwidth",
+            metavar="KB", help="bandwidth of each request in KB/s"
+            "(default: unlimited)")
+    parser.add_option("--max-rate", type="float", dest="max_rate",
+            metavar="N", help="requests per second the client may send"
+            "(default: the client's own limit)")
+    parser.add_option("--depth", type="int", dest="depth", default=3,
+            help="levels of folders in the tree(default: 3)")
+    parser.add_option("--fanout", type="int", dest="fanout", default=4,
+            help="folders in each folder(default: 4)")
+    parser.add_option("--files", type="int", dest="files", default=10,
+            help="files in each folder(default: 10)")
+    parser.add_option("--file-size", type="int", dest="file_size",
+            default=4096, metavar="BYTES",
+            help="size of each file(default: 4096)")
+    parser.add_option("-o", "--output", dest="output", metavar="FILE",
+            help="write the JSON results to FILE instead of stdout")
+    parser.add_option("--baseline", dest="baseline", metavar="FILE",
+            help="compare with the results in FILE, and exit with 1 if a "
+            "benchmark regressed")
+    parser.add_option("--threshold", type="float", dest="threshold",
+            default=0.2, help="slowdown ratio regarded as a regression"
+            "(default: 0.2)")
+    options, args = parser.parse_args(argv)
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+    return options, args or list(BENCHMARKS)
+
+
+def main(argv=None):
+    options, names = parse_args(argv)
+    # keep the user's configuration, caches and logging out of it
+    home = tempfile.mkdtemp(prefix="boxbench-home-")
+    os.environ['HOME'] = home
+    os.environ['LOG_CONF_DIR'] = home
+    with open(os.path.join(home, ".boxrc"), 'w') as f:
+        f.write(BOXRC.format(ACCOUNT,
+            datetime.now().strftime("%Y-%m-%d %H:%M")))
+    with open(os.path.join(home, "box-logging.conf"), 'w') as f:
+        f.write(LOGGING_CONF)
+
+    server = FakeBoxServer(latency=options.latency / 1000.0,
+            bandwidth=options.bandwidth and options.bandwidth * 1024).start()
+    try:
+        results = {'revision': _revision(),
+                'python': sys.version.split()[0],
+                'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'params': dict((name, getattr(options, name)) for name in (
+                    'runs', 'jobs', 'latency', 'bandwidth', 'max_rate',
+                    'depth', 'fanout', 'files', 'file_size')),
+                'benchmarks': {}}
+        for name in names:
+            print >>sys.stderr, "running {}...".format(name)
+            results['benchmarks'][name] = run_benchmark(name, server,
+                    options)
+    finally:
+        server.stop()
+        shutil.rmtree(home)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
+    if options.baseline:
+        with open(options.baseline) as f:
+            if compare(results, json.load(f), options.threshold):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of pybox's startup: the time to import the command line client
+and to run it to the point of parsing options, and which of the modules
+only needed by some commands got loaded.
+
+usage: python bench/startup.py [-n RUNS] [-o FILE] [--baseline FILE]
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import json
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules which list/info/what-id should never load
+LAZY_MODULES = ('mechanize', 'cookielib', 'poster', 'poster.encode',
+        'logging.config')
+
+CASES = (
+        ('python', ["-c", "pass"]),
+        ('import', ["-c", "import pybox.boxclient"]),
+        ('help', [os.path.join(ROOT, "pybox", "boxclient.py"), "--help"]),
+        )
+
+
+def _time_run(args, env):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable] + args, env=env,
+                stdout=devnull, cwd=ROOT)
+    return time.time() - start
+
+
+def _loaded_modules(env):
+    """Return the lazy modules loaded by importing the client"""
+    output = subprocess.check_output([sys.executable, "-c",
+        "import sys, pybox.boxclient; "
+        "print '\\n'.join(m for m in {!r} if sys.modules.get(m))".format(
+            LAZY_MODULES)], env=env, cwd=ROOT)
+    return output.split()
+
+
+def run(runs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    results = {'python': sys.version.split()[0], 'runs': runs, 'cases': {}}
+    for name, args in CASES:
+        _time_run(args, env) # warm up the file system cache
+        seconds = sorted(_time_run(args, env) for _ in range(runs))
+        results['cases'][name] = {
+                'min_ms': round(seconds[0] * 1000, 2),
+                'median_ms': round(seconds[len(seconds) // 2] * 1000, 2),
+                }
+    results['lazy_modules_loaded'] = _loaded_modules(env)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each case's median from a baseline, and return
+    the names of those slower by more than `threshold`(a ratio) and of the
+    lazy modules loaded which were not before.
+    """
+    regressions = []
+    for name, result in sorted(results['cases'].iteritems()):
+        base = baseline['cases'].get(name)
+        if not base or not base['median_ms']:
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print >>sys.stderr, "{:<8} {:>9.2f}ms -> {:>9.2f}ms x{:.2f}{}".format(
+                name, base['median_ms'], result['median_ms'], ratio, flag)
+    for module in results['lazy_modules_loaded']:
+        if module not in baseline['lazy_modules_loaded']:
+            regressions.append(module)
+            print >>sys.stderr, "{} is loaded at startup REGRESSION".format(
+                    module)
+    return regressions
+
+
+def main(argv=None):
+    parser = OptionParser("usage: %prog [-n RUNS] [-o FILE] "
+            "[--baseline FILE]")
+    parser.add_option("-n", "--runs", type="int", dest="runs", default=20,
+            help="runs of each case(default: 20)")
+    parser.add_option("-o", "--output", dest="output",
+            help="write the JSON results to FILE instead of stdout")
+    parser.add_option("--baseline", dest="baseline", metavar="FILE",
+            help="compare with the results in FILE, and exit with 1 if a "
+            "case regressed")
+    parser.add_option("--threshold", type="float", dest="threshold",
+            default=0.2, help="slowdown ratio regarded as a regression"
+            "(default: 0.2)")
+    options, _ = parser.parse_args(argv)
+    results = run(options.runs)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
+    if options.baseline:
+        with open(options.baseline) as f:
+            if compare(results, json.load(f), options.threshold):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,19 +12,38 @@ __version__ = "0.1"
 __email__ = "xyzdll[AT]gmail[DOT]com"
 
 import ConfigParser
+import Queue
+import base64
 import errno
+import hashlib
+import httplib
 import json
 import os
 import re
+import socket
+import sys
+import threading
+import time
 from datetime import datetime
 import urllib
 import urllib2
-
-from poster.encode import multipart_encode
-from poster.streaminghttp import register_openers
-
-from pybox.utils import encode, get_browser, get_logger, get_sha1, is_posix, \
-        stringify
+from StringIO import StringIO
+
+from pybox.cache import LocalManifest, PathCache, Sha1Cache, \
+        get_cache_path, stat_key
+from pybox.diff import CLIENT_FILE, CLIENT_FOLDER, DIFF_FILE, SAME_FILE, \
+        SERVER_FILE, SERVER_FOLDER, DiffRecord, RecordStore, order_key
+from pybox.index import RemoteIndex
+from pybox.metrics import RequestMetrics, endpoint_of
+from pybox.plan import MOVE_DIR, MOVE_FILE, REMOVE, RMDIR, UPLOAD_DIR, \
+        UPLOAD_FILE, SyncPlan, tree_signature
+from pybox.pool import WorkerPool
+from pybox.retry import RETRY_CODES, THROTTLE_CODES, AdaptiveLimiter, \
+        RetryPolicy, parse_retry_after
+from pybox.scanner import PARTIAL_SUFFIX, scan_dir, scan_tree
+from pybox.transport import Transport
+from pybox.utils import HashingFile, atomic_write, encode, file_lock, \
+        get_browser, get_logger, get_sha1, is_posix, stringify
 
 
 logger = get_logger()
@@ -75,111 +94,177 @@ class MethodNotALLowedError(FileError):
     pass
 
 
+class BatchError(Exception):
+    """Some tasks of a batch failed"""
+
+    def __init__(self, errors):
+        super(BatchError, self).__init__(
+                "{} task(s) failed: {}".format(len(errors),
+                    "; ".join(str(e) for _, e in errors[:10])))
+        self.errors = errors
+
+
 class DiffResult(object):
-    """Wrap diff results"""
+    """Wrap diff results.
+
+    Results are kept as compact `DiffRecord`s, at most `max_records` of them
+    in memory(the rest is spilled to disk) until `close`. If `sink` is
+    given, records are passed to it as they are found instead of being
+    kept.
+    The nodes yielded by `get_client_unique`, `get_server_unique` and
+    `get_compare` are rebuilt from the records, so they only hold the
+    type, id, name(and the SHA1 of a file).
+    """
+    MAX_RECORDS = 100000
 
     class _DiffResultItem(object):
         """Diff result for a context directory"""
 
-        def __init__(self, container, context_node, ignore_common=True):
+        def __init__(self, container, context_node, parent=None, index=0,
+                ignore_common=True):
             self.container = container
-            self.context_node = context_node
-            self._client_uniques = ([], [])
-            self._server_uniques = ([], [])
-            self._compares = ([], [])
+            self.id = context_node['id']
+            if parent is None:
+                self.relpath = u""
+                self.order = ()
+            else:
+                self.relpath = parent.relpath + "/" + context_node['name'] \
+                        if parent.relpath else context_node['name']
+                # position in a depth-first walk
+                self.order = parent.order + (index,)
+            self._key = None
             self._ignore_common = ignore_common
 
-        def get_client_unique(self, is_file):
-            return self._client_uniques[0 if is_file else 1]
-
-        def add_client_unique(self, is_file, path):
-            self.get_client_unique(is_file).append(
-                    path[self.container.local_prelen:])
+        def _add(self, kind, path, id_=None, sha1=None, size=None):
+            if self._key is None:
+                self._key = order_key(self.order)
+            self.container._add(self._key,
+                    DiffRecord(kind, path, id_, self.id, sha1, size))
 
-        def get_server_unique(self, is_file):
-            return self._server_uniques[0 if is_file else 1]
+        def add_client_unique(self, is_file, path, size=None):
+            self._add(CLIENT_FILE if is_file else CLIENT_FOLDER,
+                    path[self.container.local_prelen:], size=size)
 
         def add_server_unique(self, is_file, mapping):
-            uniques = self.get_server_unique(is_file)
+            prefix = self.relpath + "/" if self.relpath else u""
             for name, node in mapping.iteritems():
-                context = "/".join(self.container.context)
-                path = (context + "/" + name)[self.container.remote_prelen:]
-                uniques.append((path, node))
-
-        def get_compare(self, is_diff):
-            return self._compares[0 if is_diff else 1]
+                self._add(SERVER_FILE if is_file else SERVER_FOLDER,
+                        prefix + name, node['id'], node.get('sha1'),
+                        node.get('size'))
 
         def add_compare(self, is_diff, localpath, remotenode):
             if is_diff or not self._ignore_common:
-                self.get_compare(is_diff).append(
-                        (localpath[self.container.local_prelen:], remotenode))
+                self._add(DIFF_FILE if is_diff else SAME_FILE,
+                        localpath[self.container.local_prelen:],
+                        remotenode['id'], remotenode['sha1'],
+                        remotenode.get('size'))
 
-    def __init__(self, localdir, remotedir, ignore_common=True):
+    def __init__(self, localdir, remotedir, ignore_common=True,
+            max_records=None, sink=None):
         self.localdir = localdir
         self.local_prelen = len(localdir) + 1
         self.remotedir = remotedir
         self.remotename = remotedir['name']
-        self.remote_prelen = len(self.remotename) + 1
-        self.items = []
-        self.context = []
         self._ignore_common = ignore_common
+        self._store = RecordStore(max_records or self.MAX_RECORDS)
+        self._sink = sink
+        self.stopped = False
 
-    def start_add(self, context_node):
-        item = DiffResult._DiffResultItem(
-                self, context_node, self._ignore_common)
-        self.context.append(context_node['name'])
-        self.items.append(item)
-        return item
+    def add_item(self, context_node, parent=None, index=0):
+        """Add the diff result for a context directory, which is the
+        `index`th compared subdirectory of its parent's.
+        """
+        return DiffResult._DiffResultItem(
+                self, context_node, parent, index, self._ignore_common)
 
-    def end_add(self):
-        self.context.pop()
+    def _add(self, key, record):
+        if self._sink is not None:
+            if not self.stopped:
+                self._sink(record)
+        else:
+            self._store.add(key, record)
+
+    def stop(self):
+        """Stop the walk producing the result"""
+        self.stopped = True
+
+    def close(self):
+        self._store.close()
+
+    def iter_records(self, kind):
+        """Yield `DiffRecord`s of the given kind in depth-first order"""
+        return self._store.iter_records(kind)
+
+    def _context_node(self, record):
+        """Return the remote folder node a record is under"""
+        path = os.path.dirname(record.path)
+        return {'type': "folder", 'id': record.parent_id,
+                'name': os.path.basename(path) if path else self.remotename}
+
+    @staticmethod
+    def _remote_node(record, is_file):
+        node = {'type': "file" if is_file else "folder", 'id': record.id,
+                'name': os.path.basename(record.path)}
+        if is_file:
+            node['sha1'] = record.sha1
+        return node
 
     def get_client_unique(self, is_file):
-        for item in self.items:
-            for path in item.get_client_unique(is_file):
-                yield (path, item.context_node)
+        """Yield (path, context node) of client-only files or folders"""
+        for record in self.iter_records(
+                CLIENT_FILE if is_file else CLIENT_FOLDER):
+            yield record.path, self._context_node(record)
 
     def get_server_unique(self, is_file):
-        for item in self.items:
-            #yield iter(item.get_server_unique(is_file)).next()
-            for i in item.get_server_unique(is_file):
-                yield i
-
-    def get_compare(self, is_file):
-        for item in self.items:
-            for localpath, remotenode in item.get_compare(is_file):
-                yield (localpath, remotenode, item.context_node)
+        """Yield (path, node) of server-only files or folders"""
+        for record in self.iter_records(
+                SERVER_FILE if is_file else SERVER_FOLDER):
+            yield record.path, self._remote_node(record, is_file)
+
+    def get_compare(self, is_diff):
+        """Yield (path, remote node, context node) of different(or the
+        same) files.
+        """
+        for record in self.iter_records(DIFF_FILE if is_diff else SAME_FILE):
+            yield (record.path, self._remote_node(record, True),
+                    self._context_node(record))
 
     def report(self):
-        result = ([], [], [], [], [], [])
-        for item in self.items:
-            result[0].extend(item.get_client_unique(True))
-            result[1].extend(item.get_client_unique(False))
-            result[2].extend([l for l, _ in item.get_server_unique(True)])
-            result[3].extend([l for l, _ in item.get_server_unique(False)])
-            result[4].extend([l for l, _ in item.get_compare(True)])
-            if not self._ignore_common:
-                result[5].extend([l for l, _ in item.get_compare(False)])
-        return result
+        return ([r.path for r in self.iter_records(CLIENT_FILE)],
+                [r.path for r in self.iter_records(CLIENT_FOLDER)],
+                [r.path for r in self.iter_records(SERVER_FILE)],
+                [r.path for r in self.iter_records(SERVER_FOLDER)],
+                [r.path for r in self.iter_records(DIFF_FILE)],
+                [] if self._ignore_common
+                else [r.path for r in self.iter_records(SAME_FILE)])
+
+    def iter_report(self):
+        """Yield the report piece by piece"""
+        yield u"diff between client path({}) and server path({}):\n".format(
+                self.localdir, self.remotename)
+        sections = ((u"client only files", self.iter_records(CLIENT_FILE)),
+                (u"client only folders", self.iter_records(CLIENT_FOLDER)),
+                (u"server only files", self.iter_records(SERVER_FILE)),
+                (u"server only folders", self.iter_records(SERVER_FOLDER)),
+                (u"diff files", self.iter_records(DIFF_FILE)),
+                (u"common files", None if self._ignore_common
+                    else self.iter_records(SAME_FILE)))
+        for title, records in sections:
+            yield u"[{}]:\n".format(title)
+            if records is None:
+                yield u"***ignored***"
+            else:
+                for i, record in enumerate(records):
+                    yield u", " + record.path if i else record.path
+            yield u"\n"
+
+    def write_report(self, out):
+        """Write the report to the given file object as it is rendered"""
+        for piece in self.iter_report():
+            out.write(encode(piece))
 
     def __unicode__(self):
-        result = self.report()
-        return u"diff between client path({}) and server path({}):\n" \
-                "[client only files]:\n{}\n"  \
-                "[client only folders]:\n{}\n" \
-                "[server only files]:\n{}\n" \
-                "[server only folders]:\n{}\n" \
-                "[diff files]:\n{}\n" \
-                "[common files]:\n{}\n".format(
-                        self.localdir, self.remotename,
-                        ", ".join(result[0]),
-                        ", ".join(result[1]),
-                        ", ".join(result[2]),
-                        ", ".join(result[3]),
-                        ", ".join(result[4]),
-                        "***ignored***" if self._ignore_common
-                        else ", ".join(result[5]),
-                        )
+        return u"".join(self.iter_report())
 
     def __str__(self):
         return encode(unicode(self))
@@ -194,19 +279,39 @@ class BoxApi(object):
     TOKEN_URL = OAUTH_URL + "token"
     AUTH_URL = OAUTH_URL + "authorize"
     UPLOAD_URL = "https://upload.box.com/api/2.0/files{}/content"
+    UPLOAD_SESSION_URL = \
+            "https://upload.box.com/api/2.0/files{}/upload_sessions"
     DOWNLOAD_URL = BASE_URL + "files/{}/content"
+    EVENTS_URL = BASE_URL + "events"
     ROOT_ID = "0"
+    PAGE_SIZE = 1000 # the maximum allowed by box
+    # besides type and id; size decides on ranged downloads
+    LIST_FIELDS = "name,sha1,size,etag,sequence_id"
+    MAX_PENDING_FOLDERS = 4096
+    CHUNK_THRESHOLD = 64 * 1024 * 1024 # box requires at least 20MB
+    MAX_COMMIT_TRIES = 10
+    EVENTS_PAGE_SIZE = 500
+    STREAM_QUEUE_SIZE = 1024
+    DOWNLOAD_SUFFIX = PARTIAL_SUFFIX # skipped by scans of local trees
+    MAX_DOWNLOAD_TRIES = 5
+    MAX_VERIFY_TRIES = 2
+    RANGE_THRESHOLD = 256 * 1024 * 1024
+    RANGE_SAVE_INTERVAL = 4 * 1024 * 1024
     ONELEVEL = "onelevel"
     SIMPLE = "simple"
     NOFILES = "nofiles"
     TIME_FORMAT = "%Y-%m-%d %H:%M"
     MAX_TOKEN_DAYS = 60
     SAFE_TOKEN_DAYS = 10
+    ACCESS_TOKEN_SECONDS = 3600
+    TOKEN_REFRESH_MARGIN = 300
 
     # patterns
     FILENAME_PATTERN = re.compile('(.*filename=")(.+)(".*)')
 
-    def __init__(self):
+    def __init__(self, rehash=False, keep_paths=False, page_size=None,
+            jobs=1, chunk_threshold=None, range_threshold=None,
+            use_index=False, use_events=False):
         conf_file = os.path.expanduser(
                 "~/.boxrc" if is_posix() else "~/_boxrc")
         if not os.path.exists(conf_file):
@@ -227,6 +332,45 @@ class BoxApi(object):
         self._access_token = None
         self._refresh_token = None
         self._token_time = None
+        self._token_expiry = None
+        self._token_lock = threading.Lock()
+        self._sha1_cache = Sha1Cache(rehash=rehash)
+        self._path_cache = PathCache(self.ROOT_ID)
+        self._keep_paths = keep_paths
+        # the index is only trusted as far as the changes stream keeps it
+        # up to date, folder versions do not change with their contents
+        self._use_index = self._use_events = use_index or use_events
+        self._index = None
+        self.page_size = page_size or self.PAGE_SIZE
+        self.jobs = jobs
+        self.chunk_threshold = chunk_threshold or self.CHUNK_THRESHOLD
+        self.range_threshold = range_threshold or self.RANGE_THRESHOLD
+        # shared by all requests(and threads)
+        self.transport = Transport()
+        self.retry = RetryPolicy()
+        self.limiter = AdaptiveLimiter(max_concurrency=jobs)
+        self.metrics = RequestMetrics()
+        self._request_hooks = [(None, self.metrics.record)]
+
+    def flush(self):
+        """Write cached state to disk, keeping it in memory"""
+        self._sha1_cache.flush()
+        self._path_cache.save()
+        if self._index:
+            self._index.flush()
+
+    def close(self):
+        """Release local resources(e.g. flush caches to disk)"""
+        self._sha1_cache.close()
+        self._path_cache.save()
+        if self._index:
+            self._index.close()
+        self.transport.close()
+
+    def get_sha1(self, path):
+        """Get SHA1 for a local file(cached as per path, size, mtime and inode)
+        """
+        return self._sha1_cache.get_sha1(path)
 
     @staticmethod
     def _log_response(response):
@@ -252,27 +396,119 @@ class BoxApi(object):
                 response_obj['error_description']))
         return response_obj
 
-    def _auth_request(self, url, data, headers, method):
+    def add_request_hook(self, before=None, after=None):
+        """Add hooks called for each request sent(including retries):
+        `before(method, url, headers)` before it is sent(and may change
+        the headers), and `after(record)` once its response or error is
+        received. A record is a dict of method, url, endpoint(e.g.
+        "GET folders/{id}/items"), status(None if there is no response),
+        tries(1 for the first), seconds(until the response headers),
+        bytes_sent, bytes_received(as per Content-Length) and error.
+        Hooks are called on the requesting thread, and their errors are
+        logged and ignored.
+        """
+        self._request_hooks.append((before, after))
+
+    @staticmethod
+    def _call_hook(hook, *args):
+        try:
+            hook(*args)
+        except Exception as e:
+            logger.warn(u"request hook {} failed: {}".format(hook, e))
+
+    def _send_request(self, method, url, data, headers, tries=1):
+        """Send a request through the transport, calling hooks around it"""
+        for before, _ in self._request_hooks:
+            if before:
+                self._call_hook(before, method, url, headers)
+        status = error = info = None
+        start = time.time()
+        try:
+            response = self.transport.request(method, url, data, headers)
+            status, info = response.getcode(), response.info()
+            return response
+        except urllib2.HTTPError as e:
+            status, info, error = e.getcode(), e.info(), e
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            seconds = time.time() - start
+            if isinstance(data, basestring):
+                sent = len(data)
+            else:
+                sent = int(headers.get('Content-Length') or 0)
+            received = info and info.getheader('Content-Length')
+            record = {'method': method, 'url': url,
+                    'endpoint': endpoint_of(method, url), 'status': status,
+                    'tries': tries, 'seconds': seconds, 'bytes_sent': sent,
+                    'bytes_received': int(received or 0), 'error': error}
+            for _, after in self._request_hooks:
+                if after:
+                    self._call_hook(after, record)
+
+    def _auth_request(self, url, data, headers, method, token=None,
+            tries=1):
         logger.debug(u"requesting {}...".format(url))
-        req = urllib2.Request(url, data, headers)
-        if method:
-            req.get_method = lambda: method
-        req.add_header('Authorization', "Bearer {}".format(self._access_token))
-        return urllib2.urlopen(req)
+        headers = dict(headers)
+        headers['Authorization'] = "Bearer {}".format(
+                token or self._access_token)
+        if not method:
+            method = 'GET' if data is None else 'POST'
+        return self._send_request(method, url, data, headers, tries)
+
+    def _send(self, url, data, headers, method):
+        """Send an authorized request as the limiter allows. Retry once with
+        a new token on 401, and as per the retry policy on throttling,
+        server errors and broken connections(unless the body is a stream,
+        which cannot be sent again).
+        """
+        replayable = data is None or isinstance(data, basestring)
+        refreshed = False
+        tries = sends = 0
+        while True:
+            tries += 1
+            sends += 1
+            throttled = False
+            token = self._get_access_token()
+            self.limiter.acquire()
+            try:
+                return self._auth_request(url, data, headers, method, token,
+                        sends)
+            except urllib2.HTTPError as e:
+                code = e.getcode()
+                if code == 401 and not refreshed: # unauthorized
+                    refreshed = True
+                    tries -= 1
+                    self.update_auth_token(token)
+                    continue
+                throttled = code in THROTTLE_CODES
+                if code not in RETRY_CODES or not replayable \
+                        or tries >= self.retry.max_tries:
+                    raise
+                error = e
+                retry_after = parse_retry_after(
+                        e.info() and e.info().get('Retry-After'))
+            except (httplib.HTTPException, socket.error) as e:
+                if not replayable or tries >= self.retry.max_tries:
+                    raise
+                error = e
+                retry_after = None
+            finally:
+                self.limiter.release(throttled)
+            delay = self.retry.delay(tries, retry_after)
+            logger.warn(u"retrying {} in {:.1f}s after: {}".format(
+                url, delay, error))
+            time.sleep(delay)
 
     def _request(self, url, data=None, headers={}, method=None, is_json=True):
         response = None
         try:
-            response = self._auth_request(url, data, headers, method)
+            response = self._send(url, data, headers, method)
         except urllib2.HTTPError as e:
             err = e.getcode()
-            if err == 401: # unauthorized, retry
-                self.update_auth_token()
-                try: # retry
-                    response = self._auth_request(url, data, headers, method)
-                except:
-                    raise
-            elif err == 404: # not found
+            if err == 404: # not found
                 raise FileNotFoundError()
             elif err == 409: # file confliction
                 raise FileConflictionError()
@@ -293,12 +529,6 @@ class BoxApi(object):
     def _check(self):
         assert self._access_token, "access token no found"
 
-    @classmethod
-    def _get_filename(cls, response):
-        disposition = response['content-disposition']
-        logger.debug("disposition: {}".format(disposition))
-        return cls.FILENAME_PATTERN.search(disposition).groups()[1]
-
     @classmethod
     def _automate(cls, url, login, password):
         browser = get_browser(True)
@@ -360,6 +590,12 @@ class BoxApi(object):
 
         parser = self._conf_parser
         self._account = account = "account-" + account
+        if self._keep_paths:
+            self._path_cache.load(get_cache_path(
+                "paths-{}.json".format(encode(account))))
+        if self._use_index and not self._index:
+            self._index = RemoteIndex(get_cache_path(
+                "index-{}.db".format(encode(account))))
         access_token = refresh_token = token_time = None
         if not parser.has_section(account):
             logger.info("adding account section {}".format(account))
@@ -373,6 +609,8 @@ class BoxApi(object):
                 self._token_time = token_time \
                         = datetime.strptime(parser.get(
                             account, "token_time"), self.TIME_FORMAT)
+                self._token_expiry = time.mktime(token_time.timetuple()) \
+                        + self.ACCESS_TOKEN_SECONDS
                 days = (datetime.now() - token_time).days
                 if days > self.MAX_TOKEN_DAYS:
                     raise ConfigError("refresh token has expired" \
@@ -398,36 +636,90 @@ class BoxApi(object):
                 "please change configuration or relogin".format(account))
 
     def _fetch_token(self, code=None):
-        params = {
-                   'client_id': self._client_id,
-                   'client_secret': self._client_secret}
-        if code:
-            params['grant_type'] = 'authorization_code'
-            params['code'] = code
-        else:
-            params['grant_type'] = 'refresh_token'
-            params['refresh_token'] = self._refresh_token
-        params = urllib.urlencode(params)
-        logger.debug("get_token params: {}".format(params))
-        response = urllib.urlopen(self.TOKEN_URL, params)
-        rsp_obj = self._parse_response(response)
-        self._access_token = rsp_obj['access_token']
-        self._refresh_token = rsp_obj['refresh_token']
-        self._conf_parser.set(
-                self._account, "access_token", self._access_token)
-        self._conf_parser.set(
-                self._account, "refresh_token", self._refresh_token)
-        now = datetime.now()
-        self._conf_parser.set(self._account, "token_time",
-                datetime.strftime(now, self.TIME_FORMAT))
-        with open(self._conf_file, 'w') as conf:
-            self._conf_parser.write(conf)
+        """Fetch tokens and save them to the configuration file.
+        The file stays locked meanwhile, so that processes sharing an
+        account refresh its tokens one at a time.
+        """
+        with file_lock(self._conf_file + ".lock"):
+            # pick up changes by other processes
+            parser = ConfigParser.ConfigParser()
+            parser.read(self._conf_file)
+            account = self._account
+            if not parser.has_section(account):
+                parser.add_section(account)
+            elif not code and parser.has_option(account, "refresh_token") \
+                    and parser.get(account, "refresh_token") \
+                    != self._refresh_token:
+                # refreshed by another process, which has invalidated ours
+                logger.info("reuse tokens refreshed by another process")
+                self._conf_parser = parser
+                self._access_token = parser.get(account, "access_token")
+                self._refresh_token = parser.get(account, "refresh_token")
+                self._token_time = datetime.strptime(
+                        parser.get(account, "token_time"), self.TIME_FORMAT)
+                self._token_expiry = time.mktime(
+                        self._token_time.timetuple()) \
+                        + self.ACCESS_TOKEN_SECONDS
+                return self._access_token, self._refresh_token, \
+                        self._token_time
+
+            params = {
+                       'client_id': self._client_id,
+                       'client_secret': self._client_secret}
+            if code:
+                params['grant_type'] = 'authorization_code'
+                params['code'] = code
+            else:
+                params['grant_type'] = 'refresh_token'
+                params['refresh_token'] = self._refresh_token
+            params = urllib.urlencode(params)
+            logger.debug("get_token params: {}".format(params))
+            try:
+                response = self._send_request('POST', self.TOKEN_URL,
+                        params, {'Content-Type':
+                            "application/x-www-form-urlencoded"})
+            except urllib2.HTTPError as e: # carries the error description
+                response = e
+            rsp_obj = self._parse_response(response)
+            now = datetime.now()
+            self._access_token = rsp_obj['access_token']
+            self._refresh_token = rsp_obj['refresh_token']
+            self._token_time = now
+            self._token_expiry = time.time() + rsp_obj.get('expires_in',
+                    self.ACCESS_TOKEN_SECONDS)
+            parser.set(account, "access_token", self._access_token)
+            parser.set(account, "refresh_token", self._refresh_token)
+            parser.set(account, "token_time",
+                    datetime.strftime(now, self.TIME_FORMAT))
+            conf = StringIO()
+            parser.write(conf)
+            atomic_write(self._conf_file, conf.getvalue())
+            self._conf_parser = parser
         return self._access_token, self._refresh_token, now
 
-    def update_auth_token(self):
-        """Update access token"""
-        logger.info("updating tokens")
-        return self._fetch_token()
+    def update_auth_token(self, stale_token=None):
+        """Update access token.
+        Concurrent callers passing the token they found invalid(as
+        `stale_token`) share a single refresh.
+        """
+        with self._token_lock:
+            if stale_token is not None \
+                    and stale_token != self._access_token:
+                logger.debug("tokens have been updated")
+                return self._access_token, self._refresh_token, \
+                        self._token_time
+            logger.info("updating tokens")
+            return self._fetch_token()
+
+    def _get_access_token(self):
+        """Return the access token, refreshed if it is about to expire"""
+        token = self._access_token
+        expiry = self._token_expiry
+        if token and expiry \
+                and time.time() >= expiry - self.TOKEN_REFRESH_MARGIN:
+            self.update_auth_token(token)
+            token = self._access_token
+        return token
 
     def get_account_info(self):
         """Get account information
@@ -444,36 +736,71 @@ class BoxApi(object):
 
         Refer: http://developers.box.com/docs/#folders-retrieve-a-folders-items
         """
-        self._check()
-
         if not extra_params:
             extra_params = [self.ONELEVEL, self.SIMPLE]
+        entries = [f for f in self.iter_list(folder_id, by_name)]
+        return {'total_count': len(entries), 'entries': entries}
+
+    def iter_list(self, folder_id=None, by_name=False, page_size=None):
+        """Iterate over files under the given folder.
+        Pages of `page_size` entries are requested only when needed, with
+        marker-based paging(offsets above 10000 are rejected by Box).
+
+        Refer: https://developer.box.com/guides/api-calls/pagination/marker-based/
+        """
+        self._check()
+
         if not folder_id:
             folder_id = self.ROOT_ID
         elif by_name:
             folder_id = self._convert_to_id(folder_id, False)
-        url = "{}folders/{}/items".format(self.BASE_URL, encode(folder_id))
-        return self._request(url)
+        for entries in self._iter_pages(folder_id, page_size):
+            for entry in entries:
+                yield entry
+
+    def _iter_pages(self, folder_id, page_size=None):
+        """Iterate over pages(lists of entries) of the given folder"""
+        url = "{}folders/{}/items?fields={}&usemarker=true&limit={}".format(
+                self.BASE_URL, encode(folder_id), self.LIST_FIELDS,
+                page_size or self.page_size)
+        marker = None
+        while True:
+            page = self._request(url if marker is None else
+                    "{}&marker={}".format(url, urllib.quote(marker, "")))
+            entries = page['entries'] or []
+            yield entries
+            marker = page.get('next_marker')
+            if not entries or not marker:
+                break
 
     @staticmethod
     def _get_file_id(files, name, is_file):
-        if is_file:
-            type_ = "file"
+        """Find a file with the given name from files(entries).
+        If is_file is None, check both file and folder type.
+        Return id and type(whether file or not).
+        """
+        if is_file is None:
+            types = ("file", "folder")
+        elif is_file:
+            types = ("file",)
         else:
-            type_ = "folder"
-        logger.debug(u"checking {} {}".format(type_, name))
-        files = files['entries'] or []
+            types = ("folder",)
+        logger.debug(u"checking {} {}".format("/".join(types), name))
         for f in files:
-            if f['name'] == name and f['type'] == type_:
+            if f['name'] == name and f['type'] in types:
                 f_id = f['id']
                 logger.debug(u"found name '{}' with id {}".format(name, f_id))
-                return f_id
+                return f_id, f['type'] == "file"
+        return None, None
 
-    def get_file_id(self, path, is_file=None):
+    def get_file_id(self, path, is_file=None, verify=False):
         """Return the file's id for the given server path.
         If is_file is True, check only file type,
         if is_file is False, check only folder type,
         if is_file is None, check both file and folder type.
+        If verify is True, cached ids(of the file and the folders looked up
+        from) are confirmed with the server before they are used, as they
+        may have been moved or removed since.
         Return id and type(whether file or not).
         """
         if not path or path == "/":
@@ -481,31 +808,68 @@ class BoxApi(object):
 
         path = os.path.normpath(path)
         paths = [p for p in path.split(os.sep) if p]
-        folder_id = self.ROOT_ID
-        for name in paths[:-1]:
+        id_, cached_is_file = self._path_cache.lookup(paths)
+        if id_ and (is_file is None or is_file == cached_is_file):
+            if not verify or self._is_cached_id(paths, id_, cached_is_file):
+                logger.debug(u"found cached path '{}' with id {}".format(
+                    path, id_))
+                return id_, cached_is_file
+            self._path_cache.discard(id_)
+
+        # only list folders not cached yet
+        depth, folder_id = self._path_cache.longest_prefix(paths[:-1])
+        while verify and depth and not self._is_cached_id(paths[:depth],
+                folder_id, False):
+            self._path_cache.discard(folder_id)
+            depth, folder_id = self._path_cache.longest_prefix(paths[:-1])
+        for name in paths[depth:-1]:
             logger.debug(u"look up folder '{}' in {}".format(name, folder_id))
-            files = self.list(folder_id)
-            folder_id = self._get_file_id(files, name, False)
+            parent_id = folder_id
+            folder_id, _ = self._get_file_id(
+                    self._list_cached(parent_id), name, False)
             if not folder_id:
                 logger.debug(u"no found {} under folder {}".
-                        format(name, folder_id))
+                        format(name, parent_id))
                 return None, None
         # time to check name
         name = paths[-1]
         logger.debug(u"checking name: {}".format(name))
-        files = self.list(folder_id)
-        if not is_file:
-            id_ = self._get_file_id(files, name, False)
-            if id_:
-                return id_, False
-
-        if is_file is None or is_file:
-            return self._get_file_id(files, name, True), True
+        return self._get_file_id(self._list_cached(folder_id), name,
+                is_file)
 
-        return None, None
-
-    def _convert_to_id(self, name, is_file):
-        file_id, is_file = self.get_file_id(name, is_file)
+    def _list_cached(self, folder_id):
+        """Iterate over files under the given folder, caching their paths.
+        Only folders looked up by path are cached this way, other listings
+        would fill the path cache with whole trees.
+        """
+        self._check()
+        for entries in self._iter_pages(folder_id):
+            self._path_cache.add_children(folder_id, entries)
+            for entry in entries:
+                yield entry
+
+    def _is_cached_id(self, paths, id_, is_file):
+        """Whether the given id is still at the given path(a list of
+        names), i.e. its name and those of all its ancestors match.
+        """
+        url = "{}{}s/{}?fields=name,path_collection,item_status".format(
+                self.BASE_URL, "file" if is_file else "folder", encode(id_))
+        try:
+            info = self._request(url)
+        except FileNotFoundError:
+            info = {}
+        ancestors = (info.get('path_collection') or {}).get('entries') or []
+        if info.get('name') == paths[-1] \
+                and info.get('item_status', 'active') == 'active' \
+                and [f['id'] for f in ancestors[:1]] == [self.ROOT_ID] \
+                and [f['name'] for f in ancestors[1:]] == paths[:-1]:
+            return True
+        logger.debug(u"cached id {} of '{}' is outdated".format(
+            id_, "/".join(paths)))
+        return False
+
+    def _convert_to_id(self, name, is_file, verify=False):
+        file_id, is_file = self.get_file_id(name, is_file, verify)
         if not file_id:
             logger.error(u"cannot find id for {}".format(name))
             raise ValueError("wrong file name")
@@ -533,6 +897,7 @@ class BoxApi(object):
         except FileNotFoundError:
             logger.error(u"cannot find a {} with id: {}".format(
                 type_, file_id))
+            self._path_cache.discard(file_id)
             raise
         except MethodNotALLowedError:
             try:
@@ -559,7 +924,10 @@ class BoxApi(object):
         data = {"parent": {"id": encode(parent)},
                 "name": encode(name)}
         try:
-            return self._request(url, json.dumps(data))
+            folder = self._request(url, json.dumps(data))
+            self._path_cache.add(parent, name, folder['id'], False)
+            self._index_node(folder)
+            return folder
         except FileConflictionError as e:
             logger.warn(u"directory {} already exists".format(name))
             e.args = (encode(name), parent)
@@ -572,8 +940,8 @@ class BoxApi(object):
         try:
             return self.mkdir(name, parent, by_name)['id']
         except FileConflictionError as e:
-            name, parent = e.args
-            return self._get_file_id(self.list(parent), name, False)
+            _, parent = e.args
+            return self._get_file_id(self.iter_list(parent), name, False)[0]
 
     def rmdir(self, id_, recursive=False, by_name=False):
         """Remove the given directory
@@ -593,7 +961,7 @@ class BoxApi(object):
         self._check()
 
         if by_name:
-            id_ = self._convert_to_id(id_, is_file)
+            id_ = self._convert_to_id(id_, is_file, True)
         if is_file:
             type_ = "file"
         else:
@@ -602,10 +970,15 @@ class BoxApi(object):
         if recursive and not is_file:
             url += "?recursive=true"
         try:
-            return self._request(url, None, {}, 'DELETE')
+            result = self._request(url, None, {}, 'DELETE')
+            self._path_cache.discard(id_)
+            if self._index:
+                self._index.remove(id_)
+            return result
         except FileNotFoundError:
             logger.error(u"cannot find a {} with id: {}".format(
                 type_, id_))
+            self._path_cache.discard(id_)
             raise
         except RequestError:
             if not recursive and not is_file:
@@ -638,8 +1011,11 @@ class BoxApi(object):
 
     def _rename(self, is_file, id_, new_name, by_name):
         try:
-            return self._update_info(is_file, id_,
+            info = self._update_info(is_file, id_,
                     {"name": encode(new_name)}, by_name)
+            self._path_cache.rename(info['id'], new_name)
+            self._index_node(info)
+            return info
         except FileConflictionError:
             logger.error(u"{} {} already exists".format(
                 "File" if is_file else "Folder", new_name))
@@ -649,7 +1025,7 @@ class BoxApi(object):
         self._check()
 
         if by_name:
-            id_ = self._convert_to_id(id_, is_file)
+            id_ = self._convert_to_id(id_, is_file, True)
         if is_file:
             type_ = "file"
         else:
@@ -660,6 +1036,7 @@ class BoxApi(object):
         except FileNotFoundError:
             logger.error(u"cannot find a {} with id: {}".format(
                 type_, id_))
+            self._path_cache.discard(id_)
             raise
 
     def move_file(self, file_, new_folder, by_name=False):
@@ -672,54 +1049,65 @@ class BoxApi(object):
 
     def _move(self, is_file, target, new_folder, by_name):
         if by_name:
-            new_folder = self._convert_to_id(new_folder, False)
+            new_folder = self._convert_to_id(new_folder, False, True)
         try:
-            return self._update_info(is_file, target,
+            info = self._update_info(is_file, target,
                     {"parent": {"id": encode(new_folder)}}, by_name)
+            self._path_cache.move(info['id'], new_folder)
+            self._index_node(info)
+            return info
         except RequestError: # e.g. move to descendent
             logger.error(u"{} {} cannot move to {}".format(
                 "File" if is_file else "Folder", target, new_folder))
             raise
 
     def download_dir(self, folder_id, localdir=None, by_name=False):
-        """Download the directory with the given id to a local directory"""
+        """Download the directory with the given id to a local directory.
+        Folders are listed and files are downloaded on `jobs` threads.
+        """
         self._check()
 
         if by_name:
             folder_id = self._convert_to_id(folder_id, False)
 
         folder_info = self.get_file_info(folder_id, False)
-        folder_name = folder_info['name']
-        localdir = os.path.join(localdir or ".", folder_name)
+        localdir = os.path.join(localdir or ".", folder_info['name'])
+        with WorkerPool(self.jobs) as pool:
+            pool.submit(self._download_dir, folder_id, localdir, pool)
+        self._check_batch(pool)
+
+    def _download_dir(self, folder_id, localdir, pool):
         try:
             os.makedirs(localdir)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
 
-        files = folder_info['item_collection']['entries']
-        for f in (files or []):
-            file_name = f['name']
-            file_id = f['id']
+        for f in self.iter_list(folder_id):
             file_type = f['type']
             if file_type == 'file':
-                localfile = os.path.join(localdir, file_name)
-                if os.path.exists(localfile):
-                    # check
-                    sha1 = f['sha1']
-                    if get_sha1(localfile) == sha1:
-                        logger.debug("same sha1")
-                        continue
-                # download
-                self.download_file(file_id, localdir)
+                pool.submit(self._download_dir_file, f, localdir)
             elif file_type == 'folder':
-                self.download_dir(file_id, localdir)
+                pool.submit(self._download_dir, f['id'],
+                        os.path.join(localdir, f['name']), pool)
             else:
-                logger.warn(u"unexpected file type".format(file_type))
+                logger.warn(u"unexpected file type {}".format(file_type))
+
+    def _download_dir_file(self, node, localdir):
+        """Download a file(node) of a directory unless it's up to date"""
+        localfile = os.path.join(localdir, node['name'])
+        if os.path.exists(localfile):
+            # check
+            if self.get_sha1(localfile) == node['sha1']:
+                logger.debug("same sha1")
+                return
+        # download
+        self._download_file(node, localdir)
 
     def download_file(self, file_id, localdir=None, by_name=False,
             block_size=65536):
-        """Download the file with the given id to a local directory
+        """Download the file with the given id to a local directory.
+        An interrupted download resumes from the bytes already received.
 
         Refer:
         http://developers.box.com/docs/#files-download-a-file
@@ -728,20 +1116,175 @@ class BoxApi(object):
 
         if by_name:
             file_id = self._convert_to_id(file_id, True)
-        url = self.DOWNLOAD_URL.format(encode(file_id))
-        logger.debug("download url: {}".format(url))
-        stream = self._request(url, None, {}, None, False)
-        meta = stream.info()
-        name = self._get_filename(meta)
-        size = int(meta.getheaders("Content-Length")[0])
-        logger.debug("filename: {} with size: {}".format(name, size))
-        localdir = encode(localdir or ".")
-        with open(os.path.join(localdir, name), 'wb') as f:
-            while True:
-                buf = stream.read(block_size)
+        self._download_file(self.get_file_info(file_id), localdir, block_size)
+
+    def _download_file(self, node, localdir=None, block_size=65536):
+        """Download a file(node) into a temporary file, which is verified
+        against the remote SHA1 and then renamed to the file's name.
+        A corrupted download is discarded and done again.
+        With multiple jobs, large files(whose size is known) are fetched
+        as several byte ranges in parallel.
+        """
+        localfile = os.path.join(localdir or ".", node['name'])
+        tmpfile = localfile + self.DOWNLOAD_SUFFIX
+        size = node.get('size')
+        logger.debug(u"downloading {} with size: {}".format(localfile, size))
+        for tries in xrange(1, self.MAX_VERIFY_TRIES + 1):
+            if self.jobs > 1 and size and size >= self.range_threshold:
+                self._download_ranges(node['id'], tmpfile, size, block_size)
+                # ranges arrive out of order, hash them afterwards
+                sha1 = get_sha1(tmpfile)
+            else:
+                sha1 = self._download_stream(node['id'], tmpfile, block_size)
+            if sha1 == node['sha1']:
+                break
+            os.remove(tmpfile)
+            logger.warn(u"downloaded {} is corrupted(sha1 {} != {})".format(
+                localfile, sha1, node['sha1']))
+        else:
+            raise StatusError(u"failed to download {} intact after {} tries"
+                    .format(localfile, self.MAX_VERIFY_TRIES))
+        if not is_posix() and os.path.exists(localfile):
+            os.remove(localfile)
+        os.rename(tmpfile, localfile)
+        self._sha1_cache.store(localfile, sha1)
+
+    @staticmethod
+    def _hash_to(path, sha, hashed, offset, block_size):
+        """Update `sha` with bytes [hashed, offset) of the given file"""
+        if hashed >= offset:
+            return hashed
+        with open(path, 'rb') as f:
+            f.seek(hashed)
+            while hashed < offset:
+                buf = f.read(min(block_size, offset - hashed))
                 if not buf:
                     break
-                f.write(buf)
+                sha.update(buf)
+                hashed += len(buf)
+        return hashed
+
+    def _download_stream(self, file_id, path, block_size):
+        """Download a file to the given path, appending to what it has.
+        Return SHA1 of the file, computed as the bytes are written.
+        """
+        url = self.DOWNLOAD_URL.format(encode(file_id))
+        logger.debug("download url: {}".format(url))
+        progress_file = path + ".json"
+        if os.path.exists(progress_file): # left by a ranged download
+            os.remove(progress_file)
+            os.remove(path)
+        sha = hashlib.sha1()
+        hashed = 0
+        for tries in xrange(1, self.MAX_DOWNLOAD_TRIES + 1):
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            headers = {'Range': "bytes={}-".format(offset)} if offset else {}
+            try:
+                stream = self._request(url, None, headers, None, False)
+            except urllib2.HTTPError as e:
+                if e.getcode() == 416: # nothing left
+                    self._hash_to(path, sha, hashed, offset, block_size)
+                    return sha.hexdigest()
+                raise
+            if stream.getcode() != 206:
+                offset = 0
+            if offset < hashed:
+                sha = hashlib.sha1()
+                hashed = 0
+            # only bytes received by an earlier run need to be read
+            hashed = self._hash_to(path, sha, hashed, offset, block_size)
+            length = stream.info().getheader('Content-Length')
+            try:
+                with open(path, 'ab' if offset else 'wb') as f:
+                    while True:
+                        buf = stream.read(block_size)
+                        if not buf:
+                            break
+                        f.write(buf)
+                        sha.update(buf)
+                        hashed += len(buf)
+            except (httplib.HTTPException, socket.error) as e:
+                if tries == self.MAX_DOWNLOAD_TRIES:
+                    raise
+                logger.warn(u"download of {} interrupted: {}".format(
+                    file_id, e))
+                continue
+            received = os.path.getsize(path)
+            if length is None or received >= offset + int(length):
+                return sha.hexdigest()
+            logger.warn(u"download of {} interrupted at {}/{}".format(
+                file_id, received, offset + int(length)))
+        raise StatusError(u"failed to download {} after {} tries".format(
+            file_id, self.MAX_DOWNLOAD_TRIES))
+
+    def _download_ranges(self, file_id, path, size, block_size):
+        """Download a file to the given path as `jobs` byte ranges in
+        parallel. Progress is saved beside, so that the download resumes.
+        """
+        progress_file = path + ".json"
+        progress = None
+        if os.path.exists(progress_file) and os.path.exists(path):
+            with open(progress_file) as f:
+                progress = json.load(f)
+            if progress['size'] != size:
+                progress = None
+        if progress is None:
+            part_size = size // self.jobs + 1
+            progress = {'size': size, 'ranges': [[start,
+                min(start + part_size, size) - 1, start]
+                for start in xrange(0, size, part_size)]}
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        lock = threading.Lock()
+
+        def save():
+            with lock:
+                self._save_json(progress_file, progress)
+
+        save()
+        with WorkerPool(self.jobs) as pool:
+            for range_ in progress['ranges']:
+                pool.submit(self._download_range, file_id, path, range_,
+                        save, block_size)
+        self._check_batch(pool)
+        os.remove(progress_file)
+
+    def _download_range(self, file_id, path, range_, save, block_size):
+        """Download a [start, end, position] range of a file"""
+        url = self.DOWNLOAD_URL.format(encode(file_id))
+        _, end, _ = range_
+        for tries in xrange(1, self.MAX_DOWNLOAD_TRIES + 1):
+            if range_[2] > end:
+                return
+            headers = {'Range': "bytes={}-{}".format(range_[2], end)}
+            stream = self._request(url, None, headers, None, False)
+            if stream.getcode() != 206:
+                stream.close()
+                raise StatusError("byte ranges are not supported")
+            saved = range_[2]
+            try:
+                with open(path, 'r+b') as f:
+                    f.seek(range_[2])
+                    while True:
+                        buf = stream.read(block_size)
+                        if not buf:
+                            break
+                        f.write(buf)
+                        range_[2] += len(buf)
+                        if range_[2] - saved >= self.RANGE_SAVE_INTERVAL:
+                            f.flush()
+                            save()
+                            saved = range_[2]
+            except (httplib.HTTPException, socket.error) as e:
+                if tries == self.MAX_DOWNLOAD_TRIES:
+                    raise
+                logger.warn(u"download of {} interrupted: {}".format(
+                    file_id, e))
+            finally:
+                save()
+        if range_[2] <= end:
+            raise StatusError(u"failed to download {} after {} tries".format(
+                file_id, self.MAX_DOWNLOAD_TRIES))
 
     def upload(self, uploaded, parent=None, by_name=False, precheck=True):
         """Upload the given file/directory to a remote directory.
@@ -763,16 +1306,30 @@ class BoxApi(object):
         if os.path.isfile(uploaded):
             self._upload_file(uploaded, parent, precheck)
         elif os.path.isdir(uploaded):
-            self._upload_dir(uploaded, parent, precheck)
+            with WorkerPool(self.jobs) as pool:
+                pool.submit(self._upload_dir, uploaded, parent, precheck, pool)
+            self._check_batch(pool)
         else:
             logger.debug("ignore to upload {}".format(uploaded))
 
-    def _upload_dir(self, upload_dir, parent, precheck):
+    @staticmethod
+    def _check_batch(pool):
+        if pool.errors:
+            raise BatchError(pool.errors)
+
+    def _upload_dir(self, upload_dir, parent, precheck, pool):
+        """Create the given directory on the server, then schedule its
+        files and subdirectories on the pool.
+        """
         upload_dir_id = self.mkdirs(os.path.basename(upload_dir), parent)
         assert upload_dir_id, "upload_dir_id should be present"
-        for filename in os.listdir(upload_dir):
-            path = os.path.join(upload_dir, filename)
-            self.upload(path, upload_dir_id, False, precheck)
+        for entry in scan_dir(upload_dir):
+            path = os.path.join(upload_dir, entry.relpath)
+            if entry.is_dir:
+                pool.submit(self._upload_dir, path, upload_dir_id, precheck,
+                        pool)
+            else:
+                pool.submit(self._upload_file, path, upload_dir_id, precheck)
 
     def _check_file_on_server(self, filepath, parent):
         """Check if the file already exists on the server
@@ -781,8 +1338,7 @@ class BoxApi(object):
         return id if it does, but has the different SHA.
         """
         filename = os.path.basename(filepath)
-        files = self.list(parent)['entries'] or []
-        for f in files:
+        for f in self.iter_list(parent):
             name = f['name']
             if name == filename:
                 logger.debug(u"found same filename: {}".format(name))
@@ -791,7 +1347,7 @@ class BoxApi(object):
                             " the server".format(name))
                     raise FileConflictionError()
                 sha1 = f['sha1']
-                if get_sha1(filepath) == sha1:
+                if self.get_sha1(filepath) == sha1:
                     logger.debug("same sha1")
                     return True
                 else:
@@ -810,15 +1366,25 @@ class BoxApi(object):
         elif precheck:
             remote_id = precheck
 
+        if os.path.getsize(upload_file) >= self.chunk_threshold:
+            return self._upload_file_chunked(upload_file, parent, remote_id)
+
         url = self.UPLOAD_URL.format(("/" + remote_id) if remote_id else "")
         logger.debug(u"uploading {} to {}".format(upload_file, parent))
 
-        # Register the streaming http handlers with urllib2
-        register_openers()
+        stat = os.stat(upload_file)
+        # let the server verify the content if its SHA1 is already known,
+        # otherwise compute it as the file is sent
+        sha1 = self._sha1_cache.lookup(upload_file, stat)
+        localfile = upload_file
         upload_file = encode(upload_file)
+        fileobj = HashingFile(open(upload_file, 'rb'))
         # add "If-Match: ETAG_OF_ORIGINAL" for file's new version?
+        from poster.encode import multipart_encode # only needed here
         datagen, headers = multipart_encode({
-            'filename': open(upload_file), 'parent_id': parent})
+            'filename': fileobj, 'parent_id': parent})
+        if sha1:
+            headers['Content-MD5'] = sha1 # box expects SHA1 here
 
         class DataWrapper(object):
             """Fix filename encoding problem"""
@@ -852,41 +1418,309 @@ class BoxApi(object):
                     return self.datagen.next()
 
         datagen = DataWrapper(upload_file, datagen, headers)
-        return self._request(url, datagen, headers)
+        try:
+            info = self._request(url, datagen, headers)
+        finally:
+            fileobj.close()
+        node = info['entries'][0]
+        self._verify_upload(localfile, stat, fileobj.hexdigest(), node)
+        return info
+
+    def _verify_upload(self, localfile, stat, sha1, node):
+        """Check the SHA1 of the bytes sent against the uploaded file's,
+        and record it.
+        """
+        if sha1 != node['sha1']:
+            raise StatusError(u"uploaded {} is corrupted(sha1 {} != {})"
+                    .format(localfile, node['sha1'], sha1))
+        if stat_key(os.stat(localfile)) == stat_key(stat):
+            self._sha1_cache.store(localfile, sha1, stat)
+        self._index_node(node)
+
+    @staticmethod
+    def _upload_state_path(upload_file, parent, remote_id):
+        """Return where to keep the session state of a chunked upload"""
+        stat = os.stat(upload_file)
+        key = u"{}|{}|{}|{}|{}".format(os.path.abspath(upload_file),
+                stat.st_size, stat.st_mtime, parent, remote_id)
+        return get_cache_path("upload-{}.json".format(
+            hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def _load_upload_session(self, state_path):
+        """Load a saved upload session and the parts the server already has.
+        Return (None, {}) if there is none or it has expired.
+        """
+        if not os.path.exists(state_path):
+            return None, {}
+        with open(state_path) as f:
+            session = json.load(f)
+        parts = {}
+        url = session['session_endpoints']['list_parts']
+        try:
+            while True:
+                page = self._request("{}?offset={}".format(url, len(parts)))
+                entries = page['entries'] or []
+                for part in entries:
+                    parts[part['offset']] = part
+                if not entries or len(parts) >= page['total_count']:
+                    break
+        except FileNotFoundError:
+            logger.info(u"upload session {} has expired".format(
+                session['id']))
+            os.remove(state_path)
+            return None, {}
+        logger.info(u"resume upload session {} with {}/{} parts".format(
+            session['id'], len(parts), session['total_parts']))
+        return session, parts
+
+    @staticmethod
+    def _save_json(path, obj):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(obj, f)
+        os.rename(tmp, path)
+
+    def _upload_file_chunked(self, upload_file, parent, remote_id):
+        """Upload a large file in parts through an upload session.
+        The session is saved to disk, so that an interrupted upload resumes
+        from the parts already on the server.
+
+        Refer: https://developer.box.com/reference/post-files-upload-sessions/
+        """
+        stat = os.stat(upload_file)
+        size = stat.st_size
+        state_path = self._upload_state_path(upload_file, parent, remote_id)
+        session, parts = self._load_upload_session(state_path)
+        if session is None:
+            url = self.UPLOAD_SESSION_URL.format(
+                    ("/" + remote_id) if remote_id else "")
+            data = {"file_size": size,
+                    "file_name": os.path.basename(upload_file)}
+            if not remote_id:
+                data["folder_id"] = parent
+            session = self._request(url, json.dumps(data))
+            self._save_json(state_path, session)
+        logger.debug(u"uploading {} to {} in {} parts".format(
+            upload_file, parent, session['total_parts']))
+
+        part_size = session['part_size']
+        sha = hashlib.sha1()
+        with open(upload_file, 'rb') as f:
+            for offset in xrange(0, size, part_size):
+                data = f.read(part_size)
+                sha.update(data)
+                if offset not in parts:
+                    parts[offset] = self._upload_part(
+                            session, data, offset, size)
+
+        url = session['session_endpoints']['commit']
+        data = json.dumps({"parts": [parts[offset]
+            for offset in sorted(parts)]})
+        headers = {'Digest': "sha=" + base64.b64encode(sha.digest()),
+                'Content-Type': "application/json"}
+        for _ in xrange(self.MAX_COMMIT_TRIES):
+            response = self._request(url, data, headers, None, False)
+            if response.getcode() != 202: # 202: parts still processing
+                break
+            retry_after = response.info().getheader('Retry-After') or 1
+            response.read()
+            time.sleep(int(retry_after))
+        else:
+            raise StatusError("upload session {} is not committed".format(
+                session['id']))
+        info = self._parse_response(response)
+        os.remove(state_path)
+        self._verify_upload(upload_file, stat, sha.hexdigest(),
+                info['entries'][0])
+        return info
+
+    def _upload_part(self, session, data, offset, size):
+        digest = hashlib.sha1(data)
+        headers = {
+                'Digest': "sha=" + base64.b64encode(digest.digest()),
+                'Content-Range': "bytes {}-{}/{}".format(
+                    offset, offset + len(data) - 1, size),
+                'Content-Type': "application/octet-stream"}
+        part = self._request(session['session_endpoints']['upload_part'],
+                data, headers, 'PUT')['part']
+        if part.get('sha1', digest.hexdigest()) != digest.hexdigest():
+            raise StatusError("part at {} of upload session {} is corrupted"
+                    .format(offset, session['id']))
+        logger.debug(u"uploaded part {} at {}".format(part['part_id'], offset))
+        return part
 
     def compare_file(self, localfile, remotefile, by_name=False):
         """Compare files between server and client(as per SHA1)"""
-        sha1 = get_sha1(localfile)
+        sha1 = self.get_sha1(localfile)
         info = self.get_file_info(remotefile, True, by_name)
         return sha1 == info['sha1']
 
     def compare_dir(self, localdir, remotedir,
-            by_name=False, ignore_common=True):
-        """Compare directories between server and client"""
+            by_name=False, ignore_common=True, fanout=None):
+        """Compare directories between server and client.
+        Remote folders are listed breadth-first on `fanout`(default: `jobs`)
+        threads.
+        The returned `DiffResult` should be closed once used.
+        """
+        remotedir = self.get_file_info(remotedir, False, by_name)
+        localdir = os.path.normpath(localdir)
+        result = DiffResult(localdir, remotedir, ignore_common)
+        manifest = self._open_manifest(localdir, remotedir)
+        try:
+            self._compare(result, manifest, fanout)
+        except:
+            result.close()
+            raise
+        finally:
+            manifest.close()
+        return result
+
+    def iter_compare_dir(self, localdir, remotedir,
+            by_name=False, ignore_common=True, fanout=None):
+        """Like `compare_dir`, but yield `DiffRecord`s as soon as they are
+        found(in no particular order) without keeping them.
+        """
         remotedir = self.get_file_info(remotedir, False, by_name)
         localdir = os.path.normpath(localdir)
-        return self._compare_dir(localdir, remotedir,
-                DiffResult(localdir, remotedir, ignore_common))
+        records = Queue.Queue(self.STREAM_QUEUE_SIZE)
+        result = DiffResult(localdir, remotedir, ignore_common,
+                sink=records.put)
 
-    def _compare_dir(self, localdir, remotedir, result):
-        children = remotedir['item_collection']['entries']
-        server_file_map = dict((f['name'], f) \
-                            for f in children if 'sha1' in f)
-        server_folder_map = dict((f['name'], f) \
-                            for f in children if 'sha1' not in f)
-        result_item = result.start_add(remotedir)
+        def walk():
+            manifest = self._open_manifest(localdir, remotedir)
+            try:
+                self._compare(result, manifest, fanout)
+                records.put(None)
+            except Exception:
+                records.put(sys.exc_info())
+            finally:
+                manifest.close()
+
+        thread = threading.Thread(target=walk)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                record = records.get()
+                if record is None:
+                    break
+                elif isinstance(record, DiffRecord):
+                    yield record
+                else:
+                    raise record[0], record[1], record[2]
+        finally:
+            # unblock the walk and let it finish early
+            result.stop()
+            while thread.is_alive():
+                try:
+                    records.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    def _open_manifest(self, localdir, remotedir):
+        key = u"{}|{}".format(os.path.abspath(localdir), remotedir['id'])
+        return LocalManifest(get_cache_path("manifest-{}.db".format(
+            hashlib.sha1(key.encode('utf-8')).hexdigest())))
+
+    def _compare(self, result, manifest, fanout=None):
+        if self._use_events:
+            self._follow_events()
+        with WorkerPool(fanout or self.jobs, self.MAX_PENDING_FOLDERS) as pool:
+            pool.submit(self._compare_dir, result.localdir, result.remotedir,
+                    result, manifest, pool)
+        if pool.errors:
+            task, _ = pool.errors[0]
+            task.result() # re-raise
+
+    def _index_node(self, node):
+        """Record a node created or updated by us in the remote index"""
+        if self._index and node.get('parent'):
+            self._index.update(node['parent']['id'], node)
+
+    def _follow_events(self):
+        """Bring the remote index up to date with the changes stream.
+        On the first run, start the stream and index everything again.
+
+        Refer: https://developer.box.com/guides/events/user-events/
+        """
+        index = self._index
+        position = index.get_meta('stream_position')
+        if position is None:
+            position = self._request(self.EVENTS_URL +
+                    "?stream_position=now")['next_stream_position']
+            logger.info(u"start following changes from {}".format(position))
+            index.forget_listings()
+            index.set_meta('stream_position', position)
+            return
+
+        changes = 0
+        while True:
+            page = self._request("{}?stream_type=changes&stream_position={}"
+                    "&limit={}".format(self.EVENTS_URL, position,
+                        self.EVENTS_PAGE_SIZE))
+            entries = page['entries'] or []
+            for event in entries:
+                index.apply_event(event)
+                source = event.get('source') or {}
+                if 'id' in source:
+                    self._path_cache.discard(source['id'])
+            changes += len(entries)
+            position = page['next_stream_position']
+            index.set_meta('stream_position', position)
+            if not entries:
+                break
+        logger.info(u"applied {} remote change(s)".format(changes))
+
+    def _list_folder(self, folder):
+        """Return entries of a folder node. Use the remote index if the
+        folder has been indexed(the changes stream keeps it up to date).
+        """
+        if not self._index:
+            return self.iter_list(folder['id'])
+        if self._index.is_listed(folder['id']):
+            logger.debug(u"use indexed folder {}".format(folder['name']))
+            return self._index.children(folder['id'])
+        entries = [f for f in self.iter_list(folder['id'])]
+        self._index.replace_children(folder, entries)
+        return entries
+
+    def _compare_dir(self, localdir, remotedir, result, manifest, pool,
+            parent_item=None, index=0):
+        if result.stopped:
+            return
+        server_file_map = {}
+        server_folder_map = {}
+        for f in self._list_folder(remotedir):
+            if f['type'] == 'file':
+                server_file_map[f['name']] = f
+            elif f['type'] == 'folder':
+                server_folder_map[f['name']] = f
+        result_item = result.add_item(remotedir, parent_item, index)
+        reldir = localdir[result.local_prelen:]
+        # files unchanged since the last sync need no hashing
+        synced = {} if self._sha1_cache.rehash else manifest.entries(reldir)
 
         subfolders = []
-        for filename in os.listdir(localdir):
+        for entry in scan_dir(result.localdir, reldir):
+            filename = os.path.basename(entry.relpath)
             path = os.path.join(localdir, filename)
-            if os.path.isfile(path):
+            if not entry.is_dir:
                 node = server_file_map.pop(filename, None)
                 if node is None:
-                    result_item.add_client_unique(True, path)
+                    result_item.add_client_unique(True, path, entry.size)
                 else:
-                    result_item.add_compare(
-                            get_sha1(path) != node['sha1'], path, node)
-            elif os.path.isdir(path):
+                    synced_entry = synced.get(filename)
+                    if synced_entry and synced_entry[:2] == (entry.size,
+                            entry.mtime_ns):
+                        sha1 = synced_entry[2]
+                    else:
+                        sha1 = self.get_sha1(path)
+                    is_diff = sha1 != node['sha1']
+                    if not is_diff:
+                        manifest.record(reldir, filename, entry.size,
+                                entry.mtime_ns, sha1)
+                    result_item.add_compare(is_diff, path, node)
+            else:
                 folder_node = server_folder_map.pop(filename, None)
                 if folder_node is None:
                     result_item.add_client_unique(False, path)
@@ -895,64 +1729,244 @@ class BoxApi(object):
         result_item.add_server_unique(True, server_file_map)
         result_item.add_server_unique(False, server_folder_map)
         # compare recursively
-        for folder in subfolders:
+        for index, folder in enumerate(subfolders):
             path = os.path.join(localdir, folder['name'])
-            folder = self.get_file_info(folder['id'], False)
-            self._compare_dir(path, folder, result)
-        result.end_add()
-        return result
+            pool.submit(self._compare_dir, path, folder, result, manifest,
+                    pool, result_item, index)
 
     def sync(self, localdir, remotedir, dry_run=False, by_name=False,
             ignore=None):
-        """Sync directories between client and server"""
-        if dry_run:
-            logger.info("dry run...")
-        result = self.compare_dir(localdir, remotedir, by_name)
-        client_unique_files = result.get_client_unique(True)
-        for path, node in client_unique_files:
-            f = os.path.join(localdir, path)
-            id_ = node['id']
-            if ignore and ignore(f):
-                logger.info(u"ignoring file: {}".format(f))
-            else:
-                logger.info(u"uploading file: {} to node {}".format(f, id_))
-                if not dry_run:
-                    self.upload(f, id_, False, False)
-        client_unique_folders = result.get_client_unique(False)
-        for path, node in client_unique_folders:
-            f = os.path.join(localdir, path)
-            id_ = node['id']
-            logger.info(u"uploading folder: {} to node {}".format(f, id_))
-            if not dry_run:
-                self.upload(f, id_, False, False)
-
-        server_unique_files = result.get_server_unique(True)
-        for path, node in server_unique_files:
-            id_ = node['id']
-            logger.info(u"removing file {} with id = {}".format(path, id_))
-            if not dry_run:
-                self.remove(id_)
-        server_unique_folders = result.get_server_unique(False)
-        for path, node in server_unique_folders:
-            id_ = node['id']
-            logger.info(u"removing folder {} with id = {}".format(path, id_))
-            if not dry_run:
-                self.rmdir(id_)
-
-        diff_files = result.get_compare(True)
-        for localpath, remote_node, context_node in diff_files:
-            localfile = os.path.join(localdir, localpath)
-            remote_id = remote_node['id']
-            remotedir_id = context_node['id']
-            logger.info(u"uploading diff file {} with remote id = {} under {}"
-                    .format(localfile, remote_id, remotedir_id))
-            if not dry_run:
-                self.upload(localfile, remotedir_id, False, remote_id)
-
-        #diff_files = result.get_compare(False)
-        #for localpath, remote_node, context_node in diff_files:
-            #localfile = os.path.join(localdir, localpath)
-            #remote_id = remote_node['id']
-            #remotedir_id = context_node['id']
-            #print u"same file {} with remote id = {} under {}".format(
-                    #localfile, remote_id, remotedir_id)
+        """Sync directories between client and server.
+        Once all changes are done, the local files are recorded in the
+        directory's manifest.
+        Return the `SyncPlan` instead of running it if `dry_run` is True.
+        """
+        remotedir = self.get_file_info(remotedir, False, by_name)
+        localdir = os.path.normpath(localdir)
+        manifest = self._open_manifest(localdir, remotedir)
+        try:
+            plan = self._plan_sync(localdir, remotedir, manifest, ignore)
+            if dry_run:
+                return plan
+            self._run_plan(plan, manifest)
+            manifest.commit()
+        finally:
+            manifest.close()
+
+    def plan_sync(self, localdir, remotedir, plan_file=None, by_name=False,
+            ignore=None):
+        """Return the `SyncPlan` to sync directories between client and
+        server, or save it to `plan_file` to be run later by `run_plan`.
+        """
+        plan = self.sync(localdir, remotedir, True, by_name, ignore)
+        if not plan_file:
+            return plan
+        plan.save(plan_file)
+        logger.info(u"saved {} to {}".format(unicode(plan), plan_file))
+
+    def run_plan(self, plan):
+        """Run the given `SyncPlan`(or the one saved to the given file).
+        Uploaded files are added to the directory's manifest.
+        """
+        if isinstance(plan, basestring):
+            plan = SyncPlan.load(plan)
+        remotedir = {'id': plan.remote_id, 'name': plan.remote_name}
+        manifest = self._open_manifest(plan.localdir, remotedir)
+        try:
+            self._run_plan(plan, manifest)
+            # files unchanged since the plan was made are not recorded
+            manifest.commit(replace=False)
+        finally:
+            manifest.close()
+
+    def _plan_sync(self, localdir, remotedir, manifest, ignore=None):
+        plan = SyncPlan(localdir, remotedir['id'], remotedir['name'])
+        result = DiffResult(localdir, remotedir)
+        try:
+            self._compare(result, manifest)
+            moved_ids, moved_paths = self._plan_moves(localdir, result,
+                    plan, ignore)
+            for record in result.iter_records(SERVER_FILE):
+                if record.id not in moved_ids:
+                    plan.add(REMOVE, record.path, record.id)
+            for record in result.iter_records(SERVER_FOLDER):
+                if record.id not in moved_ids:
+                    plan.add(RMDIR, record.path, record.id)
+            for record in result.iter_records(CLIENT_FOLDER):
+                if record.path not in moved_paths:
+                    plan.add(UPLOAD_DIR, record.path, None, record.parent_id)
+            for record in result.iter_records(CLIENT_FILE):
+                f = os.path.join(localdir, record.path)
+                if record.path in moved_paths:
+                    continue
+                elif ignore and ignore(f):
+                    logger.info(u"ignoring file: {}".format(f))
+                else:
+                    plan.add(UPLOAD_FILE, record.path, None,
+                            record.parent_id, os.path.getsize(f))
+            for record in result.iter_records(DIFF_FILE):
+                plan.add(UPLOAD_FILE, record.path, record.id,
+                        record.parent_id, os.path.getsize(
+                            os.path.join(localdir, record.path)))
+        finally:
+            result.close()
+        return plan.optimize()
+
+    def _plan_moves(self, localdir, result, plan, ignore=None):
+        """Plan to move(and rename) server-only files and folders which have
+        the same content as client-only ones instead of uploading them
+        again. Return ids of the moved nodes and the local paths they are
+        moved to.
+
+        Files are matched by size, then by SHA1. Folders are first matched
+        by their layout(paths of everything under them), then by the SHA1s
+        of their files, so that local files are only hashed for likely
+        matches.
+        """
+        moved_ids = set()
+        moved_paths = set()
+        sources = {}
+        for record in result.iter_records(SERVER_FILE):
+            sources.setdefault(record.sha1, []).append(record)
+        # a size unknown(e.g. indexed before sizes were) matches any
+        sizes = set(record.size for records in sources.itervalues()
+                for record in records)
+        if sources:
+            with WorkerPool(self.jobs) as pool:
+                tasks = [(record, pool.submit(self.get_sha1,
+                    os.path.join(localdir, record.path)))
+                    for record in result.iter_records(CLIENT_FILE)
+                    if (record.size in sizes or None in sizes)
+                    and (not ignore or not ignore(
+                        os.path.join(localdir, record.path)))]
+            for record, task in tasks:
+                sha1 = task.result()
+                candidates = [source for source in sources.get(sha1, ())
+                        if source.size in (None, record.size)]
+                if candidates:
+                    source = candidates[0]
+                    sources[sha1].remove(source)
+                    plan.add(MOVE_FILE, record.path, source.id,
+                            record.parent_id, record.size,
+                            source=source.path, sha1=sha1)
+                    moved_ids.add(source.id)
+                    moved_paths.add(record.path)
+
+        folders = list(result.iter_records(SERVER_FOLDER))
+        targets = folders and list(result.iter_records(CLIENT_FOLDER))
+        if not targets:
+            return moved_ids, moved_paths
+        with WorkerPool(self.jobs) as pool:
+            remote_tasks = [(record, pool.submit(self._remote_tree,
+                record.id)) for record in folders]
+            # while remote trees are listed, local ones are scanned one at
+            # a time, each on `jobs` threads
+            local_trees = [(record, list(scan_tree(os.path.join(localdir,
+                record.path), self.jobs))) for record in targets]
+        layouts = {}
+        for record, task in remote_tasks:
+            items = task.result()
+            if any(sha1 for _, sha1 in items):
+                layouts.setdefault(tree_signature((path, sha1 is None)
+                    for path, sha1 in items), []).append((record, items))
+        for record, entries in local_trees:
+            candidates = layouts.get(tree_signature((entry.relpath,
+                entry.is_dir) for entry in entries))
+            if not candidates:
+                continue
+            path = os.path.join(localdir, record.path)
+            signature = tree_signature((entry.relpath, None if entry.is_dir
+                else self.get_sha1(os.path.join(path, entry.relpath)))
+                for entry in entries)
+            for i, (source, items) in enumerate(candidates):
+                if tree_signature(items) == signature:
+                    del candidates[i]
+                    plan.add(MOVE_DIR, record.path, source.id,
+                            record.parent_id, source=source.path)
+                    moved_ids.add(source.id)
+                    moved_paths.add(record.path)
+                    break
+        return moved_ids, moved_paths
+
+    def _remote_tree(self, folder_id):
+        """Return (relative path, SHA1 or None for a folder) of everything
+        under the given folder.
+        """
+        items = []
+        folders = [(folder_id, u"")]
+        while folders:
+            folder_id, relpath = folders.pop()
+            for entry in self._list_folder({'id': folder_id,
+                    'name': os.path.basename(relpath)}):
+                path = relpath + "/" + entry['name'] if relpath \
+                        else entry['name']
+                if entry['type'] == 'folder':
+                    items.append((path, None))
+                    folders.append((entry['id'], path))
+                elif entry['type'] == 'file':
+                    items.append((path, entry['sha1']))
+        return items
+
+    def _upload_synced(self, localfile, parent, remote_id, manifest,
+            reldir):
+        """Upload a file and record it in the manifest"""
+        size, mtime_ns, _ = stat_key(os.stat(localfile))
+        info = self._upload_file(localfile, parent, remote_id or False)
+        manifest.record(reldir, os.path.basename(localfile), size, mtime_ns,
+                info['entries'][0]['sha1'])
+
+    def _move_synced(self, is_file, id_, parent, localfile, manifest,
+            reldir, sha1=None):
+        """Move(and rename) a file or folder to where the local one is, and
+        record a moved file in the manifest.
+        """
+        size, mtime_ns, _ = stat_key(os.stat(localfile))
+        name = os.path.basename(localfile)
+        info = self._update_info(is_file, id_,
+                {"name": encode(name), "parent": {"id": encode(parent)}},
+                False)
+        self._path_cache.move(info['id'], parent)
+        self._path_cache.rename(info['id'], name)
+        self._index_node(info)
+        if is_file and sha1 == info.get('sha1'):
+            manifest.record(reldir, name, size, mtime_ns, sha1)
+        return info
+
+    def _run_plan(self, plan, manifest):
+        logger.info(u"running {}".format(unicode(plan)))
+        with WorkerPool(self.jobs) as pool:
+            for ops in plan.stages():
+                for op in ops:
+                    self._submit_op(plan, op, pool, manifest)
+                pool.join()
+        self._check_batch(pool)
+
+    def _submit_op(self, plan, op, pool, manifest):
+        path = op['path']
+        if op['op'] == REMOVE:
+            logger.info(u"removing file {} with id = {}".format(
+                path, op['id']))
+            pool.submit(self.remove, op['id'])
+        elif op['op'] == RMDIR:
+            logger.info(u"removing folder {} with id = {}".format(
+                path, op['id']))
+            pool.submit(self.rmdir, op['id'], True)
+        elif op['op'] in (MOVE_FILE, MOVE_DIR):
+            f = os.path.join(plan.localdir, path)
+            logger.info(u"moving {} to {} as {}".format(
+                op['source'], op['parent_id'], f))
+            pool.submit(self._move_synced, op['op'] == MOVE_FILE, op['id'],
+                    op['parent_id'], f, manifest, os.path.dirname(path),
+                    op.get('sha1'))
+        elif op['op'] == UPLOAD_DIR:
+            f = os.path.join(plan.localdir, path)
+            logger.info(u"uploading folder: {} to node {}".format(
+                f, op['parent_id']))
+            pool.submit(self._upload_dir, f, op['parent_id'], False, pool)
+        else:
+            f = os.path.join(plan.localdir, path)
+            logger.info(u"uploading file: {} to node {}{}".format(
+                f, op['parent_id'], op['id'] and
+                u" as a new version of {}".format(op['id']) or u""))
+            pool.submit(self._upload_synced, f, op['parent_id'], op['id'],
+                    manifest, os.path.dirname(path))
@@ -12,11 +12,17 @@ __license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
 __version__ = "0.1"
 __email__ = "xyzdll[AT]gmail[DOT]com"
 
+import Queue
+import json
 import sys
 import getpass
+import threading
+import time
 from optparse import OptionParser
 
-from pybox.boxapi import BoxApi, ConfigError, StatusError
+from pybox.boxapi import BoxApi, ConfigError, DiffResult, StatusError, \
+        SyncPlan
+from pybox.pool import WorkerPool
 from pybox.utils import decode_args, get_logger, print_unicode, \
         user_of_email, stringify
 
@@ -73,9 +79,40 @@ def parse_args(argv):
     parser.add_option("-S", "--sync", action="store_true", dest="sync",
             help="sync local and remote files or directories")
     parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
-            help="show what would have been transferred when sync")
+            help="print the plan of a sync instead of running it")
+    parser.add_option("--save-plan", dest="save_plan", metavar="FILE",
+            help="save the plan of a sync to FILE instead of running it")
+    parser.add_option("--run-plan", action="store_true", dest="run_plan",
+            help="run sync plans saved by --save-plan")
     parser.add_option("-f", "--from-file", dest="from_file",
             help="read arguments(separated by line break) from file")
+    parser.add_option("--rehash", action="store_true", dest="rehash",
+            help="ignore cached SHA1s(and sync manifests) and rehash all "
+            "local files")
+    parser.add_option("--keep-paths", action="store_true", dest="keep_paths",
+            help="keep server path-to-id mappings between runs")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+            help="number of concurrent transfers, and of arguments "
+            "processed at a time by actions other than transfers, compares "
+            "and syncs(default: 1)")
+    parser.add_option("--summary", dest="summary", metavar="FILE",
+            help="write a JSON summary of the outcomes to FILE(- for "
+            "stdout, printing everything else to stderr)")
+    parser.add_option("--stats", action="store_true", dest="stats",
+            help="print per-endpoint request counts, statuses, retries, "
+            "latencies and bytes to stderr at the end(since the start of "
+            "the daemon with --serve)")
+    parser.add_option("--chunked-above", type="int", dest="chunked_above",
+            metavar="MB", help="upload files of at least MB megabytes in "
+            "resumable parts(default: 64)")
+    parser.add_option("--index", action="store_true", dest="index",
+            help="the same as --events")
+    parser.add_option("--events", action="store_true", dest="events",
+            help="keep a local index of the remote tree, following remote "
+            "changes to compare without walking the tree")
+    parser.add_option("--serve", dest="serve", metavar="SOCKET",
+            help="run as a daemon keeping the client warm, serving "
+            "commands(see pybox/daemon.py) over the Unix socket SOCKET")
     (options, args) = parser.parse_args(argv)
     if options.from_file:
         with open(options.from_file) as f:
@@ -84,6 +121,13 @@ def parse_args(argv):
 
 
 def init_client(options):
+    client, tokens = create_client(options)
+    run_info_command(client, options, tokens)
+    return client
+
+
+def create_client(options):
+    """Create a client and get its tokens(may exit early on login)"""
     login = options.login
     user_account = options.user_account
     password = None
@@ -107,7 +151,11 @@ def init_client(options):
             user_account = username
 
     try:
-        client = BoxApi()
+        chunk_threshold = options.chunked_above \
+                and options.chunked_above * 1024 * 1024
+        client = BoxApi(options.rehash, options.keep_paths,
+                jobs=options.jobs, chunk_threshold=chunk_threshold,
+                use_index=options.index, use_events=options.events)
         access_token, refresh_token, token_time = client.get_auth_token(
                 user_account, login, password)
         if login:
@@ -118,7 +166,12 @@ def init_client(options):
     except (StatusError, AssertionError) as e:
         sys.stderr.write("{}\n".format(e))
         sys.exit(1)
+    return client, (access_token, refresh_token, token_time)
+
 
+def run_info_command(client, options, tokens):
+    """Run the given no-arg command, if any, then exit"""
+    access_token, refresh_token, token_time = tokens
     if options.auth_token:
         print_unicode(
                 u"access token:  {}\nrefresh token: {}\ntoken time: {}".format(
@@ -147,8 +200,6 @@ def init_client(options):
                     "file" if is_file else "folder", what_id, id_))
         sys.exit()
 
-    return client
-
 
 def get_action(client, parser, options, args):
     target = options.target
@@ -202,10 +253,19 @@ def get_action(client, parser, options, args):
     elif options.sync:
         if len(args) % 2:
             parser.error("sync's arguments must be even numbers")
-        action = 'sync'
         # pair the arguments
         args = zip(args[::2], args[1::2])
-        extra_args.append(options.dry_run)
+        if options.save_plan:
+            if len(args) > 1:
+                parser.error("only one sync can be saved to a plan file")
+            action = 'plan_sync'
+            extra_args.append(options.save_plan)
+        else:
+            action = 'sync'
+            extra_args.append(options.dry_run)
+    elif options.run_plan:
+        # plans carry ids, not names
+        return ('run_plan', args, extra_args)
     else:
         parser.error("too few options")
     extra_args.append(options.plain)
@@ -213,40 +273,234 @@ def get_action(client, parser, options, args):
     return (action, args, extra_args)
 
 
-def main(argv=None):
-    # parse the command line
-    (parser, options, args) = parse_args(argv)
+# positions of server paths in the arguments of actions, and their types
+# (True for files, False for folders, None for the given target's type)
+REMOTE_ARGS = {
+        'rename_file': ((0, True),),
+        'rename_dir': ((0, False),),
+        'move_file': ((0, True), (1, False)),
+        'move_dir': ((0, False), (1, False)),
+        'list': ((0, False),),
+        'get_file_info': ((0, None),),
+        'rmdir': ((0, False),),
+        'remove': ((0, True),),
+        'mkdir': ((1, False),),
+        'download_dir': ((0, False),),
+        'download_file': ((0, True),),
+        'upload': ((1, False),),
+        'compare_dir': ((1, False),),
+        'compare_file': ((1, True),),
+        'sync': ((1, False),),
+        'plan_sync': ((1, False),),
+        }
 
-    # initialize client(may exit early for those no-arg commands)
-    client = init_client(options)
 
-    # prepare operations
+# actions whose targets are confirmed with the server when looked up from
+# cached paths
+VERIFIED_ACTIONS = ('rename_file', 'rename_dir', 'move_file', 'move_dir',
+        'rmdir', 'remove')
+
+
+# actions which already spread a single argument over the -j threads of the
+# client, so their arguments are processed one at a time
+FANOUT_ACTIONS = ('download_dir', 'download_file', 'upload', 'compare_dir',
+        'sync', 'plan_sync')
+
+
+def prepare_calls(client, action, args, extra_args, options):
+    """Return (arg, call arguments) of each argument.
+    Server paths(with -P) of all arguments are resolved to ids up front,
+    so that lookups share listings of common folders; the call arguments
+    of a path not found are the error instead.
+    """
+    calls = []
+    for arg in args:
+        if isinstance(arg, basestring):
+            calls.append((arg, [arg] + extra_args))
+        else:
+            calls.append((arg, list(arg) + extra_args))
+    positions = REMOTE_ARGS.get(action)
+    if not options.plain or not positions:
+        return calls
+
+    ids = {}
+    for _, call_args in calls:
+        for i, is_file in positions:
+            if is_file is None:
+                is_file = options.target != 'd'
+            if call_args[i]:
+                ids[(call_args[i], is_file)] = None
+    # sorted, so that paths under the same folders are looked up in a row
+    for path, is_file in sorted(ids):
+        id_, _ = client.get_file_id(path, is_file,
+                action in VERIFIED_ACTIONS)
+        ids[(path, is_file)] = id_ or ValueError(
+                u"cannot find id for {}".format(path))
+
+    resolved = []
+    for arg, call_args in calls:
+        call_args = list(call_args)
+        for i, is_file in positions:
+            if is_file is None:
+                is_file = options.target != 'd'
+            if call_args[i]:
+                call_args[i] = ids[(call_args[i], is_file)]
+                if isinstance(call_args[i], Exception):
+                    call_args = call_args[i]
+                    break
+        else:
+            call_args[-1] = False # by_name
+        resolved.append((arg, call_args))
+    return resolved
+
+
+def run_calls(operate, calls, jobs):
+    """Run calls on `jobs` threads, yield (arg, result, exc_info, seconds)
+    of each in the input order as soon as it is done.
+    """
+    def call(call_args):
+        start = time.time()
+        try:
+            if isinstance(call_args, Exception):
+                raise call_args
+            return operate(*call_args), None, time.time() - start
+        except Exception:
+            return None, sys.exc_info(), time.time() - start
+
+    if jobs < 2 or len(calls) < 2:
+        for arg, call_args in calls:
+            yield (arg,) + call(call_args)
+        return
+
+    tasks = Queue.Queue()
+
+    def submit():
+        try:
+            for arg, call_args in calls:
+                tasks.put((arg, pool.submit(call, call_args)))
+        finally:
+            tasks.put(None)
+
+    with WorkerPool(jobs) as pool:
+        producer = threading.Thread(target=submit)
+        producer.daemon = True
+        producer.start()
+        while True:
+            item = tasks.get()
+            if item is None:
+                break
+            arg, task = item
+            yield (arg,) + task.result()
+
+
+def print_result(result, out=None):
+    out = out or sys.stdout
+    if isinstance(result, DiffResult):
+        # render a large diff without building it in memory
+        try:
+            result.write_report(out)
+            print >>out
+        finally:
+            result.close()
+    elif isinstance(result, SyncPlan):
+        result.dump(out)
+    elif result is not None:
+        print >>out, stringify(result)
+
+
+def write_summary(path, action, jobs, outcomes, resolve_seconds,
+        elapsed_seconds):
+    """Write a JSON summary of the outcomes((arg, error, seconds) of
+    each argument) to the given file("-" for stdout).
+    """
+    seconds = [s for _, _, s in outcomes]
+    failures = [{'arg': arg, 'error': error}
+            for arg, error, _ in outcomes if error is not None]
+    summary = {
+            'action': action,
+            'jobs': jobs,
+            'total': len(outcomes),
+            'succeeded': len(outcomes) - len(failures),
+            'failed': len(failures),
+            'resolve_seconds': round(resolve_seconds, 3),
+            'elapsed_seconds': round(elapsed_seconds, 3),
+            'seconds': {
+                'min': round(min(seconds), 3) if seconds else 0,
+                'mean': round(sum(seconds) / len(seconds), 3)
+                if seconds else 0,
+                'max': round(max(seconds), 3) if seconds else 0,
+                },
+            'failures': failures,
+            }
+    data = json.dumps(summary, sort_keys=True)
+    if path == "-":
+        print data
+    else:
+        with open(path, 'w') as f:
+            f.write(data + "\n")
+
+
+def execute(client, parser, options, args):
+    """Run the action given by options on each argument, return the exit
+    status.
+    """
     if len(args) == 0:
         parser.error("no arguments for the given option")
     action, args, extra_args = get_action(client, parser, options, args)
 
     # begin operations
     operate = getattr(client, action)
-    errors = 0
-    for arg in args:
-        try:
-            if isinstance(arg, basestring):
-                result = operate(arg, *extra_args)
-            #elif all(isinstance(i, basestring) for i in arg):
-            else:
-                result = operate(*(list(arg) + extra_args))
-            if result is not None:
-                print stringify(result)
-            print "action {} on {} succeeded".format(action, stringify(arg))
-        except Exception as e:
-            errors += 1
-            print "action {} on {} failed".format(action, stringify(arg))
+    jobs = 1 if action in FANOUT_ACTIONS else options.jobs
+    # keep stdout for the JSON summary alone if it goes there
+    out = sys.stderr if options.summary == "-" else sys.stdout
+    outcomes = []
+    start = time.time()
+    calls = prepare_calls(client, action, args, extra_args, options)
+    resolve_seconds = time.time() - start
+    for arg, result, exc_info, seconds in run_calls(operate, calls, jobs):
+        if exc_info is None:
+            try:
+                print_result(result, out)
+            except Exception:
+                exc_info = sys.exc_info()
+        if exc_info is None:
+            outcomes.append((arg, None, seconds))
+            print >>out, "action {} on {} succeeded".format(
+                    action, stringify(arg))
+        else:
+            e = exc_info[1]
+            outcomes.append((arg, unicode(e) or type(e).__name__, seconds))
+            print >>out, "action {} on {} failed".format(action,
+                    stringify(arg))
             sys.stderr.write("error: {}\n".format(e))
-            logger.exception(e)
+            logger.error(e, exc_info=exc_info)
+    if options.summary:
+        write_summary(options.summary, action, options.jobs, outcomes,
+                resolve_seconds, time.time() - start)
+    if options.stats:
+        sys.stderr.write("{}\n".format(client.metrics))
+    errors = sum(1 for _, error, _ in outcomes if error is not None)
     if errors > 0:
         sys.stderr.write("encountered {} error(s)\n".format(errors))
         return 1
     return 0
 
+
+def main(argv=None):
+    # parse the command line
+    (parser, options, args) = parse_args(argv)
+
+    if options.serve:
+        from pybox.daemon import serve
+        client, _ = create_client(options)
+        return serve(client, options, options.serve)
+
+    # initialize client(may exit early for those no-arg commands)
+    client = init_client(options)
+    try:
+        return execute(client, parser, options, args)
+    finally:
+        client.close()
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local caches used by the Box API.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import collections
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from pybox.utils import get_logger, get_sha1, is_posix
+
+
+logger = get_logger()
+
+CACHE_DIR = os.path.expanduser("~/.boxcache" if is_posix() else "~/_boxcache")
+FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+
+
+def get_cache_path(name, cache_dir=None):
+    """Return the path of a cache file, creating the cache directory"""
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, name)
+
+
+def _to_unicode(path):
+    if isinstance(path, str):
+        return path.decode(FS_ENCODING)
+    return path
+
+
+def open_db(path, timeout):
+    """Open a SQLite database in autocommit mode, so that a transaction is
+    only open while a batch is written(see `write_batch`); readers are not
+    blocked by writers in WAL mode.
+    """
+    db = sqlite3.connect(path, timeout, check_same_thread=False,
+            isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+def write_batch(db, statements):
+    """Run the given (sql, rows) statements in one transaction; rows of
+    None runs the statement once without parameters.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, rows in statements:
+            if rows is None:
+                db.execute(sql)
+            else:
+                db.executemany(sql, rows)
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+
+def stat_key(stat):
+    """Return the (size, mtime_ns, inode) part of a cache key"""
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1000000000)
+    return stat.st_size, mtime_ns, stat.st_ino
+
+
+class Sha1Cache(object):
+    """Persistent SHA1 cache of local files.
+
+    An entry is keyed by (path, size, mtime_ns, inode), so a file is only
+    rehashed when one of them changes. The number of entries is bounded by
+    `max_entries`; the least recently used ones are evicted first.
+    If `rehash` is True, cached digests are ignored(but still refreshed).
+    New entries and uses of cached ones are written in short batches, so
+    that other processes are not locked out; if the database cannot be
+    used(e.g. it stays locked), files are just hashed without the cache.
+    """
+    FILENAME = "sha1.db"
+    MAX_ENTRIES = 1000000
+    COMMIT_INTERVAL = 512
+    COMMIT_SECONDS = 2
+    TIMEOUT = 30
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, rehash=False):
+        self.path = path or get_cache_path(self.FILENAME)
+        self.max_entries = max_entries
+        self.rehash = rehash
+        self._lock = threading.Lock()
+        self._stored = {}
+        self._used = {}
+        self._committed = time.time()
+        try:
+            self._db = open_db(self.path, self.TIMEOUT)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sha1 ("
+                    "path TEXT PRIMARY KEY, size INTEGER, "
+                    "mtime_ns INTEGER, inode INTEGER, sha1 TEXT, used REAL)")
+            self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS sha1_used ON sha1 (used)")
+        except sqlite3.Error as e:
+            logger.warn(u"hash files without the sha1 cache {}: {}".format(
+                _to_unicode(self.path), e))
+            self._db = None
+
+    def lookup(self, path, stat=None):
+        """Return the cached SHA1 of the given file, or `None` if the file
+        has changed(or never been hashed) since it was cached.
+        """
+        if self.rehash or self._db is None:
+            return None
+        path = _to_unicode(os.path.abspath(path))
+        size, mtime_ns, inode = stat_key(stat or os.stat(path))
+        with self._lock:
+            row = self._stored.get(path)
+            if row is None:
+                try:
+                    row = self._db.execute("SELECT size, mtime_ns, inode, "
+                            "sha1 FROM sha1 WHERE path = ?",
+                            (path,)).fetchone()
+                except sqlite3.Error as e:
+                    logger.debug(u"failed to look up sha1 of {}: {}".format(
+                        path, e))
+                    return None
+            else:
+                row = row[:4]
+            if row is None or tuple(row[:3]) != (size, mtime_ns, inode):
+                return None
+            self._used[path] = time.time()
+            self._modified()
+        return row[3]
+
+    def store(self, path, sha1, stat=None):
+        """Record the SHA1 of the given file"""
+        if self._db is None:
+            return
+        path = _to_unicode(os.path.abspath(path))
+        size, mtime_ns, inode = stat_key(stat or os.stat(path))
+        with self._lock:
+            self._stored[path] = (size, mtime_ns, inode, sha1, time.time())
+            self._used.pop(path, None)
+            self._modified()
+
+    def get_sha1(self, path):
+        """Return the SHA1 of the given file, hashing it only if needed"""
+        stat = os.stat(path)
+        sha1 = self.lookup(path, stat)
+        if sha1 is None:
+            sha1 = get_sha1(path)
+            # the file may change while being hashed, then don't cache it
+            if stat_key(os.stat(path)) == stat_key(stat):
+                self.store(path, sha1, stat)
+        else:
+            logger.debug(u"cached sha1 of {}".format(_to_unicode(path)))
+        return sha1
+
+    def _modified(self):
+        if len(self._stored) + len(self._used) >= self.COMMIT_INTERVAL \
+                or time.time() - self._committed >= self.COMMIT_SECONDS:
+            self._commit()
+
+    def _commit(self):
+        stored, self._stored = self._stored, {}
+        used, self._used = self._used, {}
+        self._committed = time.time()
+        if self._db is None or not (stored or used):
+            return
+        try:
+            write_batch(self._db, [
+                ("INSERT OR REPLACE INTO sha1 VALUES (?, ?, ?, ?, ?, ?)",
+                    [(path,) + row for path, row in stored.iteritems()]),
+                ("UPDATE sha1 SET used = ? WHERE path = ?",
+                    [(t, path) for path, t in used.iteritems()])])
+            if stored:
+                self._evict()
+        except sqlite3.Error as e:
+            # only a cache, the entries will be hashed again
+            logger.warn(u"dropped {} sha1 cache update(s): {}".format(
+                len(stored) + len(used), e))
+
+    def _evict(self):
+        count = self._db.execute("SELECT COUNT(*) FROM sha1").fetchone()[0]
+        if count > self.max_entries:
+            logger.debug("evicting {} sha1 cache entries".format(
+                count - self.max_entries))
+            self._db.execute("DELETE FROM sha1 WHERE path IN ("
+                    "SELECT path FROM sha1 ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,))
+
+    def flush(self):
+        """Write pending changes to disk"""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+
+
+class _PathNode(object):
+    """A node of `PathCache`"""
+    __slots__ = ('id', 'is_file', 'name', 'parent', 'children')
+
+    def __init__(self, id_, is_file, name=None, parent=None):
+        self.id = id_
+        self.is_file = is_file
+        self.name = name
+        self.parent = parent
+        self.children = {}
+
+    def to_json(self):
+        return [self.id, self.is_file, dict((name, child.to_json())
+            for name, child in self.children.iteritems())]
+
+
+class PathCache(object):
+    """A trie mapping server paths to (id, is_file).
+
+    Lookups of paths under the same folders share the cached prefix, so a
+    folder is only listed once. Entries are updated or invalidated by id,
+    which is all most operations know about the target.
+    At most about `max_entries` entries are kept; children of the least
+    recently used folders are evicted first.
+    """
+    MAX_ENTRIES = 100000
+
+    def __init__(self, root_id, max_entries=MAX_ENTRIES):
+        self.path = None
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._root = _PathNode(root_id, False)
+        self._by_id = {root_id: self._root}
+        # folders with cached children, the least recently used first
+        self._used = collections.OrderedDict()
+
+    def load(self, path):
+        """Load the cache from the given file, and save to it on `save`"""
+        self.path = path
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                root = json.load(f)
+        except ValueError as e:
+            logger.warn(u"ignore broken path cache {}: {}".format(path, e))
+            return
+        with self._lock:
+            self._clear()
+            stack = [(self._root, root[2])]
+            listed = []
+            while stack:
+                parent, children = stack.pop()
+                if children:
+                    listed.append(parent.id)
+                for name, (id_, is_file, grandchildren) \
+                        in children.iteritems():
+                    node = self._attach(parent, name, id_, is_file)
+                    stack.append((node, grandchildren))
+            # descendants are evicted before their ancestors
+            for id_ in reversed(listed):
+                self._used[id_] = None
+            self._evict()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._root.to_json())
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.path)
+
+    def _clear(self):
+        self._root.children = {}
+        self._by_id = {self._root.id: self._root}
+        self._used.clear()
+
+    def _touch(self, node):
+        """Mark the given folder and its ancestors as used, the ancestors
+        last so that they are evicted after their descendants.
+        """
+        while node is not None:
+            if node.id in self._used:
+                del self._used[node.id]
+                self._used[node.id] = None
+            node = node.parent
+
+    def _evict(self):
+        while len(self._by_id) > self.max_entries and self._used:
+            id_, _ = self._used.popitem(last=False)
+            node = self._by_id.get(id_)
+            if node is not None:
+                for child in node.children.values():
+                    self._detach(child)
+
+    def _attach(self, parent, name, id_, is_file):
+        node = parent.children.get(name)
+        if node is not None:
+            if node.id == id_ and node.is_file == is_file:
+                return node
+            self._detach(node)
+        node = self._by_id.get(id_)
+        if node is not None:
+            self._detach(node)
+        node = _PathNode(id_, is_file, name, parent)
+        parent.children[name] = node
+        self._by_id[id_] = node
+        return node
+
+    def _detach(self, node):
+        if node.parent is not None \
+                and node.parent.children.get(node.name) is node:
+            del node.parent.children[node.name]
+        node.parent = None
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if self._by_id.get(n.id) is n:
+                del self._by_id[n.id]
+            stack.extend(n.children.itervalues())
+
+    def lookup(self, names):
+        """Return the cached (id, is_file) of the given path(a list of names),
+        or (None, None) if it is not cached.
+        """
+        with self._lock:
+            node = self._root
+            for name in names:
+                child = node.children.get(name)
+                if child is None:
+                    self._touch(node)
+                    return None, None
+                node = child
+            self._touch(node.parent)
+            return node.id, node.is_file
+
+    def longest_prefix(self, names):
+        """Return (depth, id) of the deepest cached folder along the given
+        path(a list of names).
+        """
+        with self._lock:
+            node = self._root
+            depth = 0
+            for name in names:
+                child = node.children.get(name)
+                if child is None or child.is_file:
+                    break
+                node = child
+                depth += 1
+            self._touch(node)
+            return depth, node.id
+
+    def add_children(self, parent_id, entries):
+        """Cache the given listing entries of a folder"""
+        with self._lock:
+            parent = self._by_id.get(parent_id)
+            if parent is None or parent.is_file:
+                return
+            for entry in entries:
+                if entry['type'] in ("file", "folder"):
+                    self._attach(parent, entry['name'], entry['id'],
+                            entry['type'] == "file")
+            self._used[parent_id] = None
+            self._touch(parent)
+            self._evict()
+
+    def add(self, parent_id, name, id_, is_file):
+        self.add_children(parent_id, [{'name': name, 'id': id_,
+            'type': "file" if is_file else "folder"}])
+
+    def _relink(self, node, parent, name):
+        if node.parent is not None \
+                and node.parent.children.get(node.name) is node:
+            del node.parent.children[node.name]
+        old = parent.children.get(name)
+        if old is not None:
+            self._detach(old)
+        node.name = name
+        node.parent = parent
+        parent.children[name] = node
+
+    def rename(self, id_, new_name):
+        with self._lock:
+            node = self._by_id.get(id_)
+            if node is not None and node.parent is not None:
+                self._relink(node, node.parent, new_name)
+
+    def move(self, id_, new_parent_id):
+        with self._lock:
+            node = self._by_id.get(id_)
+            if node is None or node is self._root:
+                return
+            new_parent = self._by_id.get(new_parent_id)
+            if new_parent is None or new_parent.is_file:
+                self._detach(node)
+            else:
+                self._relink(node, new_parent, node.name)
+
+    def discard(self, id_):
+        """Forget the given id(and everything under it)"""
+        with self._lock:
+            node = self._by_id.get(id_)
+            if node is not None and node is not self._root:
+                self._detach(node)
+
+
+class LocalManifest(object):
+    """Local files(size, mtime and SHA1) as of the last successful sync of
+    a directory.
+
+    Files are recorded as a sync goes(written in batches to a temporary
+    table), but the manifest is only replaced by the recorded ones on
+    `commit`.
+    """
+    TIMEOUT = 30
+    BATCH_SIZE = 512
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._batch = []
+        self._recorded = 0
+        self._db = open_db(path, self.TIMEOUT)
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                "dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, "
+                "sha1 TEXT, PRIMARY KEY (dir, name))")
+        # dropped with the connection
+        self._db.execute("CREATE TEMP TABLE recorded ("
+                "dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, "
+                "sha1 TEXT, PRIMARY KEY (dir, name))")
+
+    def entries(self, dirpath):
+        """Return {name: (size, mtime_ns, sha1)} of files in the given
+        directory(relative to the synced one).
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT name, size, mtime_ns, sha1 "
+                    "FROM files WHERE dir = ?",
+                    (_to_unicode(dirpath),)).fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def record(self, dirpath, name, size, mtime_ns, sha1):
+        """Record a file known to be in sync"""
+        with self._lock:
+            self._batch.append((_to_unicode(dirpath), _to_unicode(name),
+                size, mtime_ns, sha1))
+            if len(self._batch) >= self.BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        # only the temporary table is written, which locks no one out
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany("INSERT OR REPLACE INTO temp.recorded "
+                    "VALUES (?, ?, ?, ?, ?)", batch)
+            self._db.execute("COMMIT")
+        except:
+            self._db.execute("ROLLBACK")
+            raise
+        self._recorded += len(batch)
+
+    def commit(self, replace=True):
+        """Replace the manifest with the recorded files, or only add them
+        if `replace` is False.
+        """
+        with self._lock:
+            self._flush()
+            write_batch(self._db, ([("DELETE FROM files", None)]
+                if replace else []) + [
+                ("INSERT OR REPLACE INTO files SELECT * FROM temp.recorded",
+                    None),
+                ("DELETE FROM temp.recorded", None)])
+            logger.debug("recorded {} files in manifest {}".format(
+                self._recorded, self.path))
+            self._recorded = 0
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Daemon keeping a warm client(tokens, connections, path-to-id mappings and
+remote listings) to serve boxclient commands over a Unix socket, and the
+thin client sending them.
+
+usage: python pybox/daemon.py SOCKET [boxclient options] [args]
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+# only standard modules are imported here, so that the thin client starts
+# fast
+import SocketServer
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+
+# a reply is a sequence of frames of a channel byte, the payload length
+# and the payload; the exit frame carries the exit status and ends it
+STDOUT = 'o'
+STDERR = 'e'
+EXIT = 'x'
+HEADER = struct.Struct("!cI")
+
+# options which shape the client are taken from the daemon's command line
+CLIENT_OPTIONS = ('rehash', 'keep_paths', 'jobs', 'chunked_above', 'index',
+        'events')
+
+
+class _Channel(object):
+    """File-like object sending what is written as frames"""
+
+    def __init__(self, sock, lock, channel, encoding):
+        self._sock = sock
+        self._lock = lock
+        self._channel = channel
+        self._encoding = encoding
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode(self._encoding)
+        if data:
+            send_frame(self._sock, self._lock, self._channel, data)
+
+    def flush(self):
+        pass
+
+
+def send_frame(sock, lock, channel, data):
+    with lock:
+        sock.sendall(HEADER.pack(channel, len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("connection closed by the daemon")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = request['argv']
+            cwd = request['cwd']
+        except (ValueError, KeyError, TypeError) as e:
+            send_frame(self.connection, threading.Lock(), STDERR,
+                    "bad request: {}\n".format(e))
+            send_frame(self.connection, threading.Lock(), EXIT, "2")
+            return
+        # commands run one at a time, as the working directory and the
+        # standard streams are process-wide
+        with server.command_lock:
+            status = server.run_command(self.connection, argv, cwd)
+        try:
+            send_frame(self.connection, threading.Lock(), EXIT, str(status))
+        except socket.error: # the thin client has gone
+            pass
+
+
+class Daemon(object):
+    """Run boxclient commands on the given client"""
+
+    def __init__(self, client, options, socket_path):
+        from pybox import utils
+        self.encoding = utils.ENCODING
+        self.client = client
+        self.options = options
+        self.socket_path = os.path.abspath(socket_path)
+        self.logger = utils.get_logger()
+
+    def run_command(self, sock, argv, cwd):
+        """Run a command, sending its output to the given socket, and
+        return the exit status.
+        """
+        from pybox.boxclient import execute, parse_args, run_info_command
+        lock = threading.Lock()
+        out = _Channel(sock, lock, STDOUT, self.encoding)
+        err = _Channel(sock, lock, STDERR, self.encoding)
+        handler = logging.StreamHandler(err) # keep output parseable
+        handler.setLevel(logging.INFO)
+        saved = sys.stdout, sys.stderr, os.getcwd()
+        sys.stdout, sys.stderr = out, err
+        self.logger.addHandler(handler)
+        try:
+            os.chdir(cwd)
+            parser, options, args = parse_args(
+                    [arg.encode(self.encoding) for arg in argv])
+            if options.login:
+                parser.error("login is not supported by the daemon")
+            if options.serve:
+                parser.error("the daemon is serving already")
+            if options.user_account and \
+                    options.user_account != self.options.user_account:
+                parser.error("the daemon serves account {}".format(
+                    self.options.user_account))
+            for name in CLIENT_OPTIONS:
+                setattr(options, name, getattr(self.options, name))
+            options.user_account = self.options.user_account
+            run_info_command(self.client, options,
+                    self.client.get_auth_token(options.user_account, None))
+            return execute(self.client, parser, options, args)
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            if isinstance(e.code, int):
+                return e.code
+            err.write("{}\n".format(e.code))
+            return 1
+        except socket.error as e:
+            self.logger.warn("lost thin client: {}".format(e))
+            return 1
+        except Exception as e:
+            self.logger.exception(e)
+            err.write("error: {}\n".format(e))
+            return 1
+        finally:
+            self.logger.removeHandler(handler)
+            sys.stdout, sys.stderr = saved[:2]
+            os.chdir(saved[2])
+            try:
+                self.client.flush()
+            except Exception as e:
+                self.logger.warn("failed to flush caches: {}".format(e))
+
+    def _bind(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error: # left by a dead daemon
+                os.remove(self.socket_path)
+            else:
+                probe.close()
+                sys.stderr.write("a daemon is serving on {} already\n"
+                        .format(self.socket_path))
+                sys.exit(1)
+        old_umask = os.umask(0077)
+        try:
+            server = _Server(self.socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0600)
+        server.command_lock = threading.Lock()
+        server.run_command = self.run_command
+        return server
+
+    def serve(self):
+        server = self._bind()
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, terminate)
+        self.logger.info("serving on {}".format(self.socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info("shutting down")
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+            # let the running command finish
+            with server.command_lock:
+                self.client.close()
+        return 0
+
+
+def serve(client, options, socket_path):
+    """Serve commands on the given client until interrupted"""
+    return Daemon(client, options, socket_path).serve()
+
+
+def main(argv=None):
+    """Send a command to the daemon and relay its output"""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        sys.stderr.write(__doc__.strip().splitlines()[-1] + "\n")
+        return 2
+    encoding = sys.stdin.encoding or "UTF-8"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(argv[0])
+    except socket.error as e:
+        sys.stderr.write("cannot connect to daemon on {}: {}\n".format(
+            argv[0], e))
+        return 1
+    try:
+        sock.sendall(json.dumps({
+            'argv': [arg.decode(encoding) for arg in argv[1:]],
+            'cwd': os.getcwd().decode(sys.getfilesystemencoding())}) + "\n")
+        streams = {STDOUT: sys.stdout, STDERR: sys.stderr}
+        while True:
+            channel, size = HEADER.unpack(
+                    _recv_exactly(sock, HEADER.size))
+            data = _recv_exactly(sock, size)
+            if channel == EXIT:
+                return int(data)
+            streams[channel].write(data)
+            streams[channel].flush()
+    except (EOFError, socket.error) as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
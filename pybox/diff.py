@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact records of a diff between client and server, kept in memory or
+spilled to disk.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import collections
+import os
+import sqlite3
+import tempfile
+import threading
+
+from pybox.utils import get_logger
+
+
+logger = get_logger()
+
+# kinds of records
+CLIENT_FILE = "client_file"
+CLIENT_FOLDER = "client_folder"
+SERVER_FILE = "server_file"
+SERVER_FOLDER = "server_folder"
+DIFF_FILE = "diff_file"
+SAME_FILE = "same_file"
+
+# `path` is relative to the compared directories, `id` is the remote node
+# (None for client-only ones), `parent_id` the remote folder it is under,
+# `sha1` the remote SHA1 of a file and `size` the size of a file(the local
+# one for client-only files), if known
+DiffRecord = collections.namedtuple('DiffRecord',
+        'kind path id parent_id sha1 size')
+
+
+def order_key(order):
+    """Turn a position(a tuple of indices) in a depth-first walk to a
+    string which sorts the same way.
+    """
+    return "".join("{:08x}".format(i) for i in order)
+
+
+class RecordStore(object):
+    """Diff records sorted by the position of the folder they belong to.
+
+    At most `max_records` records are kept in memory, then all of them are
+    moved to a temporary database, which is removed on `close`.
+    """
+    FETCH_SIZE = 1000
+
+    def __init__(self, max_records):
+        self.max_records = max_records
+        self.count = 0
+        self._lock = threading.Lock()
+        self._records = []
+        self._db = None
+        self._path = None
+
+    def add(self, key, record):
+        with self._lock:
+            self._records.append((key, self.count, record))
+            self.count += 1
+            if len(self._records) > self.max_records:
+                self._spill()
+
+    def _spill(self):
+        if self._db is None:
+            fd, self._path = tempfile.mkstemp(prefix="boxdiff-", suffix=".db")
+            os.close(fd)
+            logger.debug("spilling diff records to {}".format(self._path))
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute("CREATE TABLE records (ord TEXT, seq INTEGER, "
+                    "kind TEXT, path TEXT, id TEXT, parent_id TEXT, "
+                    "sha1 TEXT, size INTEGER)")
+        self._db.executemany("INSERT INTO records VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?)",
+                [(key, seq) + tuple(record)
+                    for key, seq, record in self._records])
+        self._db.commit()
+        self._records = []
+
+    def iter_records(self, kind):
+        """Yield records of the given kind in depth-first order"""
+        with self._lock:
+            if self._db is None:
+                records = sorted(r for r in self._records if r[2].kind == kind)
+                cursor = None
+            else:
+                if self._records:
+                    self._spill()
+                self._db.execute("CREATE INDEX IF NOT EXISTS records_kind "
+                        "ON records (kind, ord, seq)")
+                cursor = self._db.execute("SELECT kind, path, id, parent_id, "
+                        "sha1, size FROM records WHERE kind = ? "
+                        "ORDER BY ord, seq",
+                        (kind,))
+        if cursor is None:
+            for _, _, record in records:
+                yield record
+            return
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield DiffRecord(*row)
+
+    def close(self):
+        with self._lock:
+            self._records = []
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                os.remove(self._path)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local index of the remote(server-side) file tree.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import sqlite3
+import threading
+import time
+
+from pybox.utils import get_logger
+
+
+logger = get_logger()
+
+FIELDS = ('id', 'parent', 'name', 'type', 'sha1', 'etag', 'sequence_id',
+        'size')
+# refer: https://developer.box.com/guides/events/event-types/
+REMOVE_EVENTS = ('ITEM_TRASH', 'ITEM_DELETE')
+RELIST_EVENTS = ('ITEM_UNDELETE_VIA_TRASH', 'ITEM_COPY')
+
+
+def get_version(node):
+    """Return the version of a folder node, or `None` if it is unknown"""
+    etag = node.get('etag')
+    sequence_id = node.get('sequence_id')
+    if etag is None and sequence_id is None:
+        return None
+    return u"{}:{}".format(etag, sequence_id)
+
+
+class RemoteIndex(object):
+    """Persistent index of remote nodes(files and folders).
+
+    Besides the nodes themselves, it records which folders have had their
+    children indexed, so that they need not be listed again as long as the
+    index follows the changes stream(see `apply_event`).
+    """
+    COMMIT_INTERVAL = 256
+    COMMIT_SECONDS = 2
+    TIMEOUT = 30
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._committed = time.time()
+        self._db = sqlite3.connect(path, self.TIMEOUT,
+                check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                "id TEXT PRIMARY KEY, parent TEXT, name TEXT, type TEXT, "
+                "sha1 TEXT, etag TEXT, sequence_id TEXT, listed TEXT, "
+                "size INTEGER)")
+        # added later, unknown in indexes made before
+        if 'size' not in [row[1] for row in
+                self._db.execute("PRAGMA table_info(nodes)")]:
+            self._db.execute("ALTER TABLE nodes ADD COLUMN size INTEGER")
+        self._db.execute(
+                "CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?",
+                    (key,)).fetchone()
+        return row and row[0]
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (key, value))
+            self._commit()
+
+    def is_listed(self, folder_id):
+        """Whether children of the given folder have been indexed"""
+        with self._lock:
+            row = self._db.execute("SELECT listed FROM nodes WHERE id = ?",
+                    (folder_id,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def forget_listings(self):
+        """Mark all folders as not indexed, they will be listed again"""
+        with self._lock:
+            self._db.execute("UPDATE nodes SET listed = NULL")
+            self._commit()
+
+    def children(self, folder_id):
+        """Return indexed children of a folder as listing entries"""
+        with self._lock:
+            rows = self._db.execute("SELECT {} FROM nodes WHERE parent = ?"
+                    .format(", ".join(FIELDS)), (folder_id,)).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(FIELDS, row))
+            del entry['parent']
+            if entry['type'] != 'file':
+                del entry['sha1']
+                del entry['size']
+            entries.append(entry)
+        return entries
+
+    def get(self, id_):
+        """Return the indexed node with the given id, or `None`"""
+        with self._lock:
+            row = self._db.execute("SELECT {} FROM nodes WHERE id = ?"
+                    .format(", ".join(FIELDS)), (id_,)).fetchone()
+        return row and dict(zip(FIELDS, row))
+
+    def _upsert(self, parent_id, node):
+        values = (parent_id, node['name'], node['type'], node.get('sha1'),
+                node.get('etag'), node.get('sequence_id'), node.get('size'))
+        # keep `listed` of existing folders
+        if not self._db.execute("UPDATE nodes SET parent = ?, name = ?, "
+                "type = ?, sha1 = ?, etag = ?, sequence_id = ?, size = ? "
+                "WHERE id = ?", values + (node['id'],)).rowcount:
+            self._db.execute("INSERT INTO nodes ({}) VALUES ({})".format(
+                ", ".join(FIELDS), ", ".join("?" * len(FIELDS))),
+                (node['id'],) + values)
+
+    def _remove(self, id_):
+        ids = [id_]
+        while ids:
+            id_ = ids.pop()
+            ids.extend(row[0] for row in self._db.execute(
+                "SELECT id FROM nodes WHERE parent = ?", (id_,)))
+            self._db.execute("DELETE FROM nodes WHERE id = ?", (id_,))
+
+    def replace_children(self, folder, entries):
+        """Index the complete listing of the given folder node"""
+        folder_id = folder['id']
+        with self._lock:
+            old = set(row[0] for row in self._db.execute(
+                "SELECT id FROM nodes WHERE parent = ?", (folder_id,)))
+            for entry in entries:
+                old.discard(entry['id'])
+                self._upsert(folder_id, entry)
+            for id_ in old:
+                self._remove(id_)
+            self._db.execute("INSERT OR IGNORE INTO nodes (id, name, type) "
+                    "VALUES (?, ?, 'folder')", (folder_id, folder['name']))
+            # an empty version still tells the folder has been listed
+            self._db.execute("UPDATE nodes SET listed = ? WHERE id = ?",
+                    (get_version(folder) or u"", folder_id))
+            self._modified()
+
+    def update(self, parent_id, node):
+        """Index a created, updated or moved node"""
+        with self._lock:
+            self._upsert(parent_id, node)
+            self._modified()
+
+    def remove(self, id_):
+        """Remove a node(and everything under it) from the index"""
+        with self._lock:
+            self._remove(id_)
+            self._modified()
+
+    def apply_event(self, event):
+        """Apply an event of the changes stream to the index"""
+        node = event.get('source')
+        if not node or node.get('type') not in ('file', 'folder'):
+            return
+        old = self.get(node['id'])
+        if old and old['sequence_id'] and node.get('sequence_id') \
+                and int(old['sequence_id']) > int(node['sequence_id']):
+            logger.debug(u"skip outdated event {}".format(event['event_id']))
+            return
+        if event['event_type'] in REMOVE_EVENTS \
+                or node.get('item_status', 'active') != 'active':
+            self.remove(node['id'])
+        elif node.get('parent'):
+            self.update(node['parent']['id'], node)
+            if event['event_type'] in RELIST_EVENTS:
+                with self._lock:
+                    self._db.execute("UPDATE nodes SET listed = NULL "
+                            "WHERE id = ?", (node['id'],))
+
+    def _modified(self):
+        self._pending += 1
+        if self._pending >= self.COMMIT_INTERVAL \
+                or time.time() - self._committed >= self.COMMIT_SECONDS:
+            self._commit()
+
+    def _commit(self):
+        self._db.commit()
+        self._pending = 0
+        self._committed = time.time()
+
+    def flush(self):
+        """Write pending changes to disk"""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-endpoint metrics of Box requests.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import bisect
+import re
+import threading
+import urlparse
+
+from pybox.utils import encode
+
+# upper bounds(in milliseconds) of latency histogram buckets, the last
+# bucket takes the rest
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+ID_PATTERN = re.compile(r"^(\d+|[0-9A-Fa-f]{16,})$")
+API_PREFIXES = ("api", "2.0")
+
+
+def endpoint_of(method, url):
+    """Return the endpoint of a request, e.g. "GET folders/{id}/items" """
+    segments = [s for s in urlparse.urlsplit(url).path.split("/") if s]
+    while segments and segments[0] in API_PREFIXES:
+        segments.pop(0)
+    return u"{} {}".format(method, "/".join(
+        "{id}" if ID_PATTERN.match(s) else s for s in segments))
+
+
+class _Endpoint(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, record):
+        self.requests += 1
+        if record['tries'] > 1:
+            self.retries += 1
+        status = record['status']
+        if status is None:
+            self.errors += 1
+        else:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_sent += record['bytes_sent'] or 0
+        self.bytes_received += record['bytes_received'] or 0
+        seconds = record['seconds']
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS,
+            seconds * 1000)] += 1
+
+    def percentile(self, fraction):
+        """Return the upper bound(in milliseconds) of the bucket holding
+        the given fraction of requests.
+        """
+        rank = fraction * self.requests
+        count = 0
+        for i, n in enumerate(self.buckets):
+            count += n
+            if count >= rank and n:
+                if i < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[i]
+                break
+        return round(self.max_seconds * 1000, 1)
+
+    def to_json(self):
+        bounds = ["<={}".format(b) for b in LATENCY_BUCKETS] \
+                + [">{}".format(LATENCY_BUCKETS[-1])]
+        return {'requests': self.requests, 'retries': self.retries,
+                'errors': self.errors,
+                'statuses': dict((str(code), n)
+                    for code, n in self.statuses.iteritems()),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'seconds': round(self.seconds, 4),
+                'max_ms': round(self.max_seconds * 1000, 1),
+                'p50_ms': self.percentile(0.5),
+                'p95_ms': self.percentile(0.95),
+                'latency_ms': dict((bound, n)
+                    for bound, n in zip(bounds, self.buckets) if n)}
+
+
+class RequestMetrics(object):
+    """Counts of requests, retries, errors(no response) and status codes,
+    latency histograms and bytes sent and received, per endpoint.
+
+    `record` takes the records passed to the after-request hooks of
+    `BoxApi`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, record):
+        with self._lock:
+            endpoint = self._endpoints.get(record['endpoint'])
+            if endpoint is None:
+                endpoint = self._endpoints[record['endpoint']] = _Endpoint()
+            endpoint.add(record)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def to_json(self):
+        """Return the metrics of each endpoint"""
+        with self._lock:
+            return dict((name, endpoint.to_json())
+                    for name, endpoint in self._endpoints.iteritems())
+
+    def __unicode__(self):
+        metrics = self.to_json()
+        lines = [u"{:<36} {:>6} {:>5} {:>5} {:>7} {:>7} {:>8} {:>10} {:>10}"
+                .format("endpoint", "reqs", "retry", "error", "p50 ms",
+                    "p95 ms", "max ms", "sent KB", "recv KB")]
+        for name in sorted(metrics):
+            m = metrics[name]
+            lines.append(u"{:<36} {:>6} {:>5} {:>5} {:>7} {:>7} {:>8} "
+                    u"{:>10.1f} {:>10.1f}  {}".format(name, m['requests'],
+                        m['retries'], m['errors'], m['p50_ms'], m['p95_ms'],
+                        m['max_ms'], m['bytes_sent'] / 1024.0,
+                        m['bytes_received'] / 1024.0,
+                        " ".join("{}:{}".format(code, n) for code, n
+                            in sorted(m['statuses'].iteritems()))))
+        return u"\n".join(lines)
+
+    def __str__(self):
+        return encode(unicode(self))
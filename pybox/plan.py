@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Serializable plan of a sync between a local directory and a remote folder.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from pybox.utils import encode, get_logger
+
+
+logger = get_logger()
+
+# operations
+REMOVE = "remove"
+RMDIR = "rmdir"
+MOVE_DIR = "move_dir"
+MOVE_FILE = "move_file"
+UPLOAD_DIR = "upload_dir"
+UPLOAD_FILE = "upload_file"
+
+# operations of a stage only depend on those of former stages(e.g. a
+# remote folder must be gone before a local file of the same name is
+# uploaded or moved), so each stage can run in parallel
+STAGES = ((REMOVE, RMDIR), (MOVE_DIR, MOVE_FILE, UPLOAD_DIR, UPLOAD_FILE))
+
+
+def _remote_path(path):
+    return path.replace(os.sep, "/")
+
+
+def tree_signature(items):
+    """Return a signature of a tree from its (relative path, value) items,
+    which is the same for the same items in any order.
+    """
+    sha = hashlib.sha1()
+    for path, value in sorted((_remote_path(path), value)
+            for path, value in items):
+        sha.update(u"{}\0{}\n".format(path, value).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class SyncPlan(object):
+    """Operations which bring a remote folder in sync with a local directory.
+
+    An operation is a dict with the keys:
+        op: one of REMOVE, RMDIR, MOVE_DIR, MOVE_FILE, UPLOAD_DIR and
+            UPLOAD_FILE
+        path: path relative to the synced directories
+        id: the remote file or folder(None for new ones)
+        parent_id: the remote folder to upload or move to
+        size: size of the local file to upload
+    and for moves:
+        source: the path moved from
+        sha1: SHA1 of the moved file
+    """
+    VERSION = 1
+
+    def __init__(self, localdir, remote_id, remote_name, ops=None,
+            created=None):
+        self.localdir = os.path.abspath(localdir)
+        self.remote_id = remote_id
+        self.remote_name = remote_name
+        self.ops = ops or []
+        self.created = created or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def add(self, op, path, id_=None, parent_id=None, size=None, **extra):
+        self.ops.append(dict(extra, op=op, path=path, id=id_,
+            parent_id=parent_id, size=size))
+
+    def optimize(self):
+        """Drop operations made redundant by a folder operation(e.g. a file
+        removal under a removed folder), and put operations in the order of
+        stages. Within a stage, moves(which are cheap) come first, then
+        folder uploads(which fan out), then file uploads from the largest
+        one.
+        """
+        folders = set(_remote_path(op['path']) for op in self.ops
+                if op['op'] in (RMDIR, MOVE_DIR, UPLOAD_DIR))
+        seen = set()
+        ops = []
+        for op in self.ops:
+            key = (op['op'], op['path'])
+            if key in seen:
+                continue
+            seen.add(key)
+            parent = os.path.dirname(_remote_path(op['path']))
+            while parent and parent not in folders:
+                parent = os.path.dirname(parent)
+            if parent:
+                logger.debug(u"{} {} is covered by its folder".format(
+                    op['op'], op['path']))
+                continue
+            ops.append(op)
+        ranks = dict((name, (i, j)) for i, stage in enumerate(STAGES)
+                for j, name in enumerate(stage))
+        ops.sort(key=lambda op: (ranks[op['op']], -(op['size'] or 0)))
+        self.ops = ops
+        return self
+
+    def stages(self):
+        """Return operations grouped by stage"""
+        return [[op for op in self.ops if op['op'] in stage]
+                for stage in STAGES]
+
+    def to_json(self):
+        return {'version': self.VERSION, 'created': self.created,
+                'localdir': self.localdir, 'remote_id': self.remote_id,
+                'remote_name': self.remote_name, 'ops': self.ops}
+
+    @classmethod
+    def from_json(cls, obj):
+        if obj.get('version') != cls.VERSION:
+            raise ValueError("unsupported sync plan version: {}".format(
+                obj.get('version')))
+        return cls(obj['localdir'], obj['remote_id'], obj['remote_name'],
+                obj['ops'], obj['created'])
+
+    def dump(self, out):
+        """Write the plan as JSON, an operation per line"""
+        header = self.to_json()
+        del header['ops']
+        out.write(json.dumps(header, sort_keys=True)[:-1])
+        out.write(', "ops": [')
+        for i, op in enumerate(self.ops):
+            out.write(",\n " if i else "\n ")
+            out.write(json.dumps(op, sort_keys=True))
+        out.write("\n]}\n")
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            self.dump(f)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_json(json.load(f))
+
+    def __unicode__(self):
+        counts = {}
+        for op in self.ops:
+            counts[op['op']] = counts.get(op['op'], 0) + 1
+        return u"sync plan of {} to {}: {}".format(self.localdir,
+                self.remote_name, ", ".join(u"{} {}".format(counts[name], name)
+                    for stage in STAGES for name in stage if name in counts)
+                or u"nothing to do")
+
+    def __str__(self):
+        return encode(unicode(self))
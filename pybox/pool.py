@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+A bounded worker pool for running Box requests concurrently.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import Queue
+import sys
+import threading
+
+from pybox.utils import get_logger
+
+
+logger = get_logger()
+
+
+class Task(object):
+    """A task submitted to `WorkerPool`"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+        return self._exc_info is None
+
+    @property
+    def error(self):
+        return self._exc_info and self._exc_info[1]
+
+    def result(self):
+        """Wait for the task, return its result or raise its error"""
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def __unicode__(self):
+        return u"{}{!r}".format(self.func.__name__, self.args)
+
+
+class WorkerPool(object):
+    """Run tasks on `jobs` threads.
+
+    At most `max_pending` tasks wait in the queue, `submit` blocks when it
+    is full. A task submitted from a worker thread runs in place when the
+    queue is full instead, so workers never wait for each other.
+    A failed task does not stop the others: its error is logged and kept
+    in `errors` as a (task, exception) pair.
+    With less than two jobs, tasks simply run in the calling thread.
+    """
+    QUEUE_FACTOR = 4
+
+    def __init__(self, jobs=1, max_pending=None):
+        self.jobs = jobs
+        self.errors = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        if jobs > 1:
+            self._queue = Queue.Queue(
+                    max_pending or jobs * self.QUEUE_FACTOR)
+            for _ in xrange(jobs):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _work(self):
+        self._local.is_worker = True
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                self._run(task)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, task):
+        if not task.run():
+            logger.error(u"task {} failed: {}".format(
+                unicode(task), task.error))
+            with self._lock:
+                self.errors.append((task, task.error))
+
+    def submit(self, func, *args):
+        """Schedule `func(*args)` and return its `Task`"""
+        task = Task(func, args)
+        if not self._threads:
+            self._run(task)
+        elif getattr(self._local, 'is_worker', False):
+            try:
+                self._queue.put_nowait(task)
+            except Queue.Full:
+                self._run(task)
+        else:
+            self._queue.put(task)
+        return task
+
+    def join(self):
+        """Wait until all submitted tasks are done"""
+        if self._threads:
+            self._queue.join()
+
+    def close(self):
+        """Wait for all tasks and stop the workers"""
+        self.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+Retry policy and adaptive rate limiting of Box requests.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import email.utils
+import random
+import threading
+import time
+
+from pybox.utils import get_logger
+
+
+logger = get_logger()
+
+# refer: https://developer.box.com/guides/api-calls/permissions-and-errors/
+THROTTLE_CODES = (429, 503)
+RETRY_CODES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """Return seconds to wait as per a Retry-After header(in seconds or an
+    HTTP date), or `None` if it is absent or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter.
+
+    A request is tried at most `max_tries` times. The n-th retry waits a
+    random time up to `base_delay` * 2^(n-1) seconds(but `max_delay` at
+    most), or as long as the server asks with Retry-After.
+    """
+    MAX_TRIES = 5
+    BASE_DELAY = 1
+    MAX_DELAY = 60
+    MAX_RETRY_AFTER = 300
+
+    def __init__(self, max_tries=MAX_TRIES, base_delay=BASE_DELAY,
+            max_delay=MAX_DELAY):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, tries, retry_after=None):
+        """Return seconds to wait after the given number of tries"""
+        if retry_after is not None:
+            # spread the clients told to come back at the same time
+            return min(retry_after, self.MAX_RETRY_AFTER) \
+                    + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay,
+            self.base_delay * 2 ** (tries - 1)))
+
+
+class AdaptiveLimiter(object):
+    """Token bucket limiting both the rate and the concurrency of requests.
+
+    Throttled responses halve the rate and the concurrency, while each
+    round of successful ones grows them back by one, up to `max_rate`
+    (requests per second) and `max_concurrency`.
+    """
+    MAX_RATE = 50
+    MIN_RATE = 0.5
+
+    def __init__(self, max_rate=MAX_RATE, max_concurrency=1):
+        self.max_rate = self.rate = float(max_rate)
+        self.max_concurrency = self.concurrency = max(1, max_concurrency)
+        self._cond = threading.Condition()
+        self._tokens = self.rate
+        self._stamp = time.time()
+        self._in_flight = 0
+        self._successes = 0
+
+    def _refill(self):
+        now = time.time()
+        # allow a burst of a second's worth of requests
+        self._tokens = min(max(1.0, self.rate),
+                self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self):
+        """Wait until a request may be sent"""
+        with self._cond:
+            while True:
+                self._refill()
+                if self._in_flight >= self.concurrency:
+                    self._cond.wait()
+                elif self._tokens < 1:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+
+    def release(self, throttled=False):
+        """Tell a request is done, and whether it was throttled"""
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.rate = max(self.MIN_RATE, self.rate / 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                self._tokens = min(self._tokens, 0.0)
+                self._successes = 0
+                logger.info("throttled, slowing down to {:.1f} requests/s "
+                        "with {} at a time".format(self.rate,
+                            self.concurrency))
+            elif self.rate < self.max_rate \
+                    or self.concurrency < self.max_concurrency:
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self._successes = 0
+                    self.rate = min(self.max_rate, self.rate + 1)
+                    self.concurrency = min(self.max_concurrency,
+                            self.concurrency + 1)
+            self._cond.notify_all()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scanner of local directory trees.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import collections
+import os
+import stat as statmod
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # the backport for python 2
+    except ImportError:
+        scandir = None
+
+from pybox.cache import stat_key
+from pybox.pool import WorkerPool
+from pybox.utils import get_logger
+
+
+logger = get_logger()
+
+# suffix of partial downloads, which with their progress files are left
+# by interrupted downloads and are not part of the tree
+PARTIAL_SUFFIX = ".boxpart"
+PARTIAL_SUFFIXES = (PARTIAL_SUFFIX, PARTIAL_SUFFIX + ".json",
+        PARTIAL_SUFFIX + ".json.tmp")
+
+# size and mtime_ns are None for directories
+LocalEntry = collections.namedtuple('LocalEntry',
+        'relpath is_dir size mtime_ns')
+
+
+def _scan_entries(path):
+    """Yield (name, is_dir, stat) of regular files and directories under the
+    given directory, stat being None for directories.
+    """
+    for entry in scandir(path):
+        try:
+            # use d_type if the file system provides it
+            if entry.is_dir():
+                yield entry.name, True, None
+            elif entry.is_file():
+                yield entry.name, False, entry.stat()
+            else:
+                logger.debug(u"ignore {}".format(entry.path))
+        except OSError as e: # e.g. removed meanwhile
+            logger.debug(u"ignore {}: {}".format(entry.path, e))
+
+
+def _list_entries(path):
+    for name in os.listdir(path):
+        fullpath = os.path.join(path, name)
+        try:
+            stat = os.stat(fullpath)
+        except OSError as e: # e.g. broken link
+            logger.debug(u"ignore {}: {}".format(fullpath, e))
+            continue
+        if statmod.S_ISDIR(stat.st_mode):
+            yield name, True, None
+        elif statmod.S_ISREG(stat.st_mode):
+            yield name, False, stat
+        else:
+            logger.debug(u"ignore {}".format(fullpath))
+
+
+def scan_dir(root, reldir=u""):
+    """Return `LocalEntry`s of regular files and directories directly under
+    `reldir` of `root`, other files and broken links are ignored.
+    Partial downloads are ignored too.
+    Only files are stat'ed if `os.scandir`(or the `scandir` package) is
+    available, otherwise every entry is.
+    """
+    path = os.path.join(root, reldir) if reldir else root
+    entries = []
+    for name, is_dir, stat in (_scan_entries if scandir else _list_entries)(
+            path):
+        relpath = os.path.join(reldir, name)
+        if not is_dir and name.endswith(PARTIAL_SUFFIXES):
+            logger.debug(u"ignore partial download {}".format(relpath))
+            continue
+        if is_dir:
+            entries.append(LocalEntry(relpath, True, None, None))
+        else:
+            size, mtime_ns, _ = stat_key(stat)
+            entries.append(LocalEntry(relpath, False, size, mtime_ns))
+    return entries
+
+
+def scan_tree(root, jobs=1):
+    """Yield `LocalEntry`s of everything under `root` breadth-first,
+    scanning directories on `jobs` threads.
+    """
+    with WorkerPool(jobs) as pool:
+        pending = collections.deque([pool.submit(scan_dir, root)])
+        while pending:
+            for entry in pending.popleft().result():
+                yield entry
+                if entry.is_dir:
+                    pending.append(pool.submit(scan_dir, root, entry.relpath))
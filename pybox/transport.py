@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTTP transport with keep-alive connections pooled per host.
+"""
+
+__author__ = "Hui Zheng"
+__copyright__ = "Copyright 2011-2012 Hui Zheng"
+__credits__ = ["Hui Zheng"]
+__license__ = "MIT <http://www.opensource.org/licenses/mit-license.php>"
+__version__ = "0.1"
+__email__ = "xyzdll[AT]gmail[DOT]com"
+
+import base64
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+from pybox.utils import get_logger
+
+
+logger = get_logger()
+
+
+class Response(object):
+    """A response which gives its connection back to the pool once the body
+    has been read.
+
+    It mimics the response returned by `urllib2.urlopen`.
+    """
+
+    def __init__(self, transport, key, conn, response, url):
+        self._transport = transport
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._url = url
+        if response.length == 0: # e.g. 204, HEAD
+            response.read()
+            self._release()
+
+    def getcode(self):
+        return self._response.status
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self._url
+
+    def read(self, amt=None):
+        data = self._response.read(amt) if amt else self._response.read()
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            if not self._response.isclosed():
+                # the connection is unusable until the body is read
+                self._conn.close()
+                self._conn = None
+            else:
+                self._release()
+
+    def _release(self):
+        if self._conn is not None:
+            self._transport._release(self._key, self._conn,
+                    self._response.will_close)
+            self._conn = None
+
+
+class Transport(object):
+    """Send HTTP(S) requests over keep-alive connections.
+
+    Idle connections are pooled per (scheme, host), at most `max_idle` of
+    them each. A connection is used by one request at a time, so the
+    transport can be shared by multiple threads.
+    Like `urllib2.urlopen`, redirects are followed, a status of 400 or
+    above raises `urllib2.HTTPError`, and proxies are taken from the
+    environment(e.g. `https_proxy` and `no_proxy`) unless given as a
+    {scheme: proxy URL} dict.
+    """
+    MAX_IDLE = 16
+    MAX_REDIRECTS = 5
+    TIMEOUT = 120
+    REDIRECT_CODES = (301, 302, 303, 307)
+
+    def __init__(self, max_idle=MAX_IDLE, timeout=TIMEOUT, proxies=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self._proxy_cache = {}
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = {'requests': 0, 'connections': 0, 'reused': 0}
+
+    def stats(self):
+        """Return counters of requests sent, connections opened and
+        connections reused.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _acquire(self, key):
+        """Return an idle connection to the given (scheme, host) or a new
+        one, and whether it is reused.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._stats['reused'] += 1
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _proxy(self, key):
+        """Return (host, headers) of the proxy to the given (scheme, host),
+        or None to connect directly.
+        """
+        with self._lock:
+            if key in self._proxy_cache:
+                return self._proxy_cache[key]
+        scheme, host = key
+        proxy = self.proxies.get(scheme)
+        if proxy and not urllib.proxy_bypass(host):
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            parsed = urlparse.urlsplit(proxy)
+            headers = {}
+            if parsed.username:
+                headers['Proxy-Authorization'] = "Basic " + \
+                        base64.b64encode("{}:{}".format(
+                            urllib.unquote(parsed.username),
+                            urllib.unquote(parsed.password or "")))
+            proxy = (parsed.hostname + (":{}".format(parsed.port)
+                if parsed.port else ""), headers)
+        else:
+            proxy = None
+        with self._lock:
+            self._proxy_cache[key] = proxy
+        return proxy
+
+    def _connect(self, key):
+        self._count('connections')
+        scheme, host = key
+        proxy = self._proxy(key)
+        logger.debug("opening connection to {}://{}{}".format(scheme, host,
+            " through proxy {}".format(proxy[0]) if proxy else ""))
+        if proxy is None:
+            if scheme == 'https':
+                return httplib.HTTPSConnection(host, timeout=self.timeout)
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+        proxy_host, proxy_headers = proxy
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(proxy_host, timeout=self.timeout)
+            conn.set_tunnel(host, headers=proxy_headers)
+            return conn
+        # plain HTTP requests go to the proxy with absolute URLs
+        return httplib.HTTPConnection(proxy_host, timeout=self.timeout)
+
+    def _release(self, key, conn, will_close=False):
+        if not will_close:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    @staticmethod
+    def _send(conn, method, path, body, headers):
+        if body is None or isinstance(body, basestring):
+            conn.request(method, path, body, headers)
+        else: # an iterable of chunks, e.g. a multipart generator
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for name, value in headers.iteritems():
+                conn.putheader(name, value)
+            conn.endheaders()
+            for chunk in body:
+                conn.send(chunk)
+        return conn.getresponse()
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request and return its `Response`"""
+        headers = dict(headers or {})
+        for _ in xrange(self.MAX_REDIRECTS + 1):
+            parsed = urlparse.urlsplit(url)
+            key = (parsed.scheme, parsed.netloc)
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?" + parsed.query
+            proxy = self._proxy(key)
+            headers.pop('Proxy-Authorization', None) # e.g. redirected
+            if proxy and parsed.scheme == 'http':
+                path = "http://{}{}".format(parsed.netloc, path)
+                headers.update(proxy[1])
+            self._count('requests')
+            conn, reused = self._acquire(key)
+            try:
+                response = self._send(conn, method, path, body, headers)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # the server may have dropped an idle connection, retry
+                # unless the body cannot be sent again
+                if not reused or not (body is None
+                        or isinstance(body, basestring)):
+                    raise
+                conn = self._connect(key)
+                try:
+                    response = self._send(conn, method, path, body, headers)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    raise
+
+            status = response.status
+            if status in self.REDIRECT_CODES:
+                location = response.getheader('location')
+                response.read()
+                self._release(key, conn, response.will_close)
+                url = urlparse.urljoin(url, location)
+                logger.debug("redirected to {}".format(url))
+                if status == 303 or method == 'POST':
+                    method, body = 'GET', None
+                    headers.pop('Content-Type', None)
+                    headers.pop('Content-Length', None)
+                continue
+            if status >= 400:
+                data = response.read()
+                self._release(key, conn, response.will_close)
+                raise urllib2.HTTPError(url, status, response.reason,
+                        response.msg, StringIO(data))
+            return Response(self, key, conn, response, url)
+        raise urllib2.HTTPError(url, status, "too many redirects",
+                response.msg, None)
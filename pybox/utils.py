@@ -15,25 +15,31 @@ import os
 import sys
 import re
 
-import ConfigParser
-import cookielib
+import contextlib
 import hashlib
 import logging
-import logging.config
-import mechanize
+import threading
 import xml.etree.ElementTree
 try:
     import xml.etree.cElementTree as etree
 except ImportError:
     import xml.etree.ElementTree as etree
+try:
+    import fcntl
+except ImportError: # e.g. on Windows
+    fcntl = None
 
-ENCODING = sys.stdin.encoding # typically "UTF-8"
+# stdin has no encoding if not a terminal(e.g. for a daemon)
+ENCODING = sys.stdin.encoding or "UTF-8"
 
 LOGGER_CONF_FILE = os.path.join(
         os.getenv('LOG_CONF_DIR') or ".", "box-logging.conf")
 LOGGER_NAME = "box"
 EMAIL_REGEX = re.compile(r"([^@]+)@[^@]+\.[^@]+")
 
+_logger = None
+_logger_lock = threading.Lock()
+
 
 def is_posix():
     return os.name == 'posix'
@@ -51,6 +57,61 @@ def get_sha1(file_obj, block_size=65536):
     return sha.hexdigest()
 
 
+class HashingFile(object):
+    """Wrap a file object to compute SHA1 of the bytes read from it"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._sha = hashlib.sha1()
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._sha.update(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        self._fileobj.seek(offset, whence)
+        if self._fileobj.tell() == 0: # read again
+            self._sha = hashlib.sha1()
+
+    def hexdigest(self):
+        return self._sha.hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock of the given file across processes(where
+    supported), creating it if needed.
+    """
+    with open(path, 'a') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write(path, data):
+    """Replace the given file with the given data, so that readers see
+    either the old content or the new one.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0777)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if not is_posix() and os.path.exists(path):
+        os.remove(path) # rename does not replace files on Windows
+    os.rename(tmp, path)
+
+
 def encode(unicode_str):
     """Encode the given unicode as stdin's encoding"""
     return unicode_str.encode(ENCODING)
@@ -61,19 +122,49 @@ def print_unicode(unicode_str):
     print encode(unicode_str)
 
 
-def get_logger():
-    """Return a logger with the given name from the given configuration file"""
-    if not os.path.exists(LOGGER_CONF_FILE):
-        sys.stderr.write("log configuration file {} does NOT exist\n"
-                .format(LOGGER_CONF_FILE))
-        sys.exit(1)
+def _configure_logger():
+    """Configure logging from the configuration file(or log to stderr if it
+    is missing or broken) once, and return the logger.
+    """
+    global _logger
+    with _logger_lock:
+        if _logger is not None:
+            return _logger
+        import ConfigParser
+        import logging.config
+        logger = logging.getLogger(LOGGER_NAME)
+        if not os.path.exists(LOGGER_CONF_FILE):
+            sys.stderr.write("log configuration file {} does NOT exist\n"
+                    .format(LOGGER_CONF_FILE))
+        else:
+            try:
+                logging.config.fileConfig(LOGGER_CONF_FILE)
+                _logger = logger
+                return _logger
+            except ConfigParser.Error as e:
+                sys.stderr.write("logger configuration error - {}\n"
+                        .format(e))
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        _logger = logger
+        return _logger
+
+
+class _LazyLogger(object):
+    """Logger configuring logging on first use, so that importing modules
+    neither reads the configuration nor fails without it.
+    """
+
+    def __getattr__(self, name):
+        return getattr(_logger or _configure_logger(), name)
 
-    try:
-        logging.config.fileConfig(LOGGER_CONF_FILE)
-        return logging.getLogger(LOGGER_NAME)
-    except ConfigParser.Error as e:
-        sys.stderr.write("logger configuration error - {}\n".format(e))
-        sys.exit(1)
+
+def get_logger():
+    """Return the logger(configured from the configuration file on first
+    use)"""
+    return _LazyLogger()
 
 
 def parse_xml(source):
@@ -106,6 +197,10 @@ def map_element(element):
 
 def get_browser(debug=False):
     """Gets a browser for automating interaction"""
+    # only needed to login, and slow to import
+    import cookielib
+    import mechanize
+
     browser = mechanize.Browser()
 
     # Cookie Jar